@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+
+# Estimativa de consumo (kWh/mês e kWh/ano) a partir dos registros de campo.
+# Todos os registros viram um DataFrame; os campos numéricos (digitados como
+# texto, com vírgula decimal) são convertidos em bloco, e a potência elétrica
+# por unidade é calculada por aba com operações vetorizadas.
+
+CAMPO_UC = "Nome da Unidade Consumidora"
+CAMPO_QTD = "Quantidade"
+CAMPO_HORAS = "Funcionamento Horas/Dia"
+CAMPO_DIAS = "Funcionamento Dias/Mês"
+CAMPO_MESES = "Funcionamento Meses/Ano"
+
+BTUH_PARA_KW = 0.00029307107
+CV_PARA_KW = 0.73549875
+EFICIENCIA_PADRAO_AR = 3.0  # Wh/Wh, quando o campo não foi preenchido
+
+# Por aba: campo de quantidade e campos numéricos usados na potência.
+# Painéis Fotovoltaicos (geração) e Aquecimento de Água (sem regime de uso)
+# ficam fora da estimativa.
+CAMPOS_POR_ABA = {
+    "Ar Condicionado": {"qtd": "Qntd. de Aparelhos", "campos": ["Potência(BTU/h)", "Eficiência (Wh/Wh)"]},
+    "Iluminação": {"qtd": "Qntd. de lâmpadas", "campos": ["Potência (W)"]},
+    "Motores e Acionamento": {"qtd": CAMPO_QTD, "campos": ["Potência do Motor (cv)", "Carregamento Médio (%)", "Rendimento Nominal (%)"]},
+    "Refrigeração": {"qtd": CAMPO_QTD, "campos": ["Potência nominal (kW)", "Fator de utilização (%)"]},
+    "Outras Cargas": {"qtd": CAMPO_QTD, "campos": ["Potência instalada (kW)", "Potência nominal (W)"]},
+}
+
+NIVEIS = {
+    "UC": ["UC"],
+    "UC > Pavimento": ["UC", "Pavimento"],
+    "UC > Pavimento > Ambiente": ["UC", "Pavimento", "Ambiente"],
+    "Tipo de Equipamento": ["Tipo"],
+    "UC > Tipo de Equipamento": ["UC", "Tipo"],
+}
+
+def para_numero(serie):
+    """
+    Converte uma coluna digitada em campo para número, em bloco: aceita vírgula
+    decimal e ponto de milhar ("1.234,5"). O que não converte vira NaN.
+    """
+    return _numero_de_texto(serie.astype("string").str.strip())
+
+def _numero_de_texto(texto):
+    # "1.234,5" e "12.000": o ponto é separador de milhar
+    milhar = texto.str.contains(",", regex=False, na=False) | texto.str.fullmatch(r"\d{1,3}(\.\d{3})+", na=False)
+    texto = texto.where(~milhar, texto.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    return pd.to_numeric(texto, errors="coerce").astype("float64")
+
+def _campos_numericos():
+    campos = {CAMPO_HORAS, CAMPO_DIAS, CAMPO_MESES}
+    for cfg in CAMPOS_POR_ABA.values():
+        campos.add(cfg["qtd"])
+        campos.update(cfg["campos"])
+    return sorted(campos)
+
+def montar_quadro(registros):
+    """
+    Retorna (quadro, problemas). 'quadro' tem uma linha por registro de aba com
+    estimativa, já com kW por unidade, quantidade, kWh/mês e kWh/ano; 'problemas'
+    lista os valores preenchidos que não puderam ser lidos como número.
+    """
+    registros = [r for r in registros if r.get("tipo_equipamento") in CAMPOS_POR_ABA]
+    campos = _campos_numericos()
+    dados = [r.get("dados", {}) for r in registros]
+    bruto = pd.DataFrame({campo: [d.get(campo) for d in dados] for campo in campos}, dtype=object)
+    quadro = pd.DataFrame({
+        "ID": [r.get("id") for r in registros],
+        "UC": [r.get("cod_instalacao") or d.get(CAMPO_UC, "UC Indefinida") for r, d in zip(registros, dados)],
+        "Pavimento": [d.get("Pavimento", "-") for d in dados],
+        "Ambiente": [d.get("Ambiente", "-") for d in dados],
+        "Tipo": pd.Categorical([r.get("tipo_equipamento") for r in registros]),
+    })
+    for col in ("UC", "Pavimento", "Ambiente"):
+        quadro[col] = quadro[col].astype(str)
+
+    textos = {campo: bruto[campo].astype("string").str.strip() for campo in campos}
+    numeros = pd.DataFrame({campo: _numero_de_texto(texto) for campo, texto in textos.items()})
+    preenchido = pd.DataFrame({campo: texto.fillna("").ne("") for campo, texto in textos.items()})
+
+    # Preenchido mas não numérico, só nos campos que valem para a aba do registro
+    relevante = pd.DataFrame(False, index=quadro.index, columns=campos)
+    for aba, cfg in CAMPOS_POR_ABA.items():
+        mascara = (quadro["Tipo"] == aba).to_numpy()
+        for campo in [cfg["qtd"], CAMPO_HORAS, CAMPO_DIAS, CAMPO_MESES] + cfg["campos"]:
+            relevante.loc[mascara, campo] = True
+    invalido = relevante & preenchido & numeros.isna()
+    problemas = invalido.stack()
+    problemas = problemas[problemas].reset_index()
+    problemas = pd.DataFrame({
+        "UC": quadro["UC"].to_numpy()[problemas["level_0"]],
+        "Tipo": quadro["Tipo"].astype(str).to_numpy()[problemas["level_0"]],
+        "Campo": problemas["level_1"].to_numpy(),
+        "Valor": bruto.to_numpy()[problemas["level_0"], [campos.index(c) for c in problemas["level_1"]]],
+    })
+
+    tipo = quadro["Tipo"]
+    kw = pd.Series(np.nan, index=quadro.index)
+    qtd = pd.Series(np.nan, index=quadro.index)
+
+    m = tipo == "Ar Condicionado"
+    eficiencia = numeros["Eficiência (Wh/Wh)"].where(numeros["Eficiência (Wh/Wh)"] > 0, EFICIENCIA_PADRAO_AR)
+    kw[m] = numeros["Potência(BTU/h)"][m] * BTUH_PARA_KW / eficiencia[m]
+    qtd[m] = numeros["Qntd. de Aparelhos"][m]
+
+    m = tipo == "Iluminação"
+    kw[m] = numeros["Potência (W)"][m] / 1000
+    qtd[m] = numeros["Qntd. de lâmpadas"][m]
+
+    m = tipo == "Motores e Acionamento"
+    carregamento = numeros["Carregamento Médio (%)"].fillna(100) / 100
+    rendimento = numeros["Rendimento Nominal (%)"].where(numeros["Rendimento Nominal (%)"] > 0, 100) / 100
+    kw[m] = (numeros["Potência do Motor (cv)"] * CV_PARA_KW * carregamento / rendimento)[m]
+    qtd[m] = numeros[CAMPO_QTD][m]
+
+    m = tipo == "Refrigeração"
+    kw[m] = (numeros["Potência nominal (kW)"] * numeros["Fator de utilização (%)"].fillna(100) / 100)[m]
+    qtd[m] = numeros[CAMPO_QTD][m]
+
+    m = tipo == "Outras Cargas"
+    kw[m] = numeros["Potência instalada (kW)"].fillna(numeros["Potência nominal (W)"] / 1000)[m]
+    qtd[m] = numeros[CAMPO_QTD][m]
+
+    quadro["kW por unidade"] = kw
+    quadro["Quantidade"] = qtd.fillna(1)
+    quadro["kWh/mês"] = kw * quadro["Quantidade"] * numeros[CAMPO_HORAS] * numeros[CAMPO_DIAS]
+    quadro["kWh/ano"] = quadro["kWh/mês"] * numeros[CAMPO_MESES].fillna(12)
+    return quadro, problemas
+
+def resumo_consumo(quadro, nivel="UC"):
+    """Soma de kWh/mês e kWh/ano (e contagem de itens) no nível pedido."""
+    chaves = NIVEIS[nivel]
+    resumo = quadro.assign(sem_estimativa=quadro["kWh/mês"].isna()).groupby(chaves, observed=True, sort=True).agg(
+        Itens=("ID", "size"),
+        sem_estimativa=("sem_estimativa", "sum"),
+        **{"kWh/mês": ("kWh/mês", "sum"), "kWh/ano": ("kWh/ano", "sum")},
+    ).reset_index()
+    return resumo.rename(columns={"sem_estimativa": "Sem estimativa"}).sort_values("kWh/ano", ascending=False)
+
+def gravar_aba_resumo(book, registros, nome_aba="Resumo de Consumo"):
+    """Acrescenta ao workbook exportado uma aba com o consumo por UC e tipo."""
+    quadro, _ = montar_quadro(registros)
+    if quadro.empty: return
+    resumo = resumo_consumo(quadro, "UC > Tipo de Equipamento")
+    ws = book.create_sheet(nome_aba)
+    ws.append(list(resumo.columns))
+    for linha in resumo.itertuples(index=False):
+        ws.append([round(v, 2) if isinstance(v, float) else v for v in linha])
@@ -2,48 +2,119 @@ import streamlit as st
 import json
 import os
 import bcrypt
-from utils import carregar_dados_locais, carregar_modelo_atual
+import time
+import threading
+import perf
+from contextlib import contextmanager
+from utils import carregar_dados_locais, carregar_modelo_atual, IndiceUC, bloqueio_arquivo, gravar_json_atomico
 
 USUARIOS_FILE = "usuarios.json"
 
+# Custo do bcrypt calibrado para o tempo alvo de uma verificação neste servidor
+BCRYPT_ALVO_MS = float(os.environ.get("POUP_BCRYPT_ALVO_MS", "250"))
+BCRYPT_CUSTO_MIN = int(os.environ.get("POUP_BCRYPT_CUSTO_MIN", "10"))
+BCRYPT_CUSTO_MAX = 14
+
+_custo_calibrado = None
+_trava_calibracao = threading.Lock()
+
 # CRIPTOGRAFIA 
+def calibrar_custo_bcrypt():
+    """
+    Maior custo cujo hash cabe no tempo alvo (BCRYPT_ALVO_MS), nunca abaixo de
+    BCRYPT_CUSTO_MIN. Mede uma vez o custo mínimo e extrapola (cada +1 dobra o
+    tempo). Calculado uma vez por processo.
+    """
+    global _custo_calibrado
+    with _trava_calibracao:
+        if _custo_calibrado is None:
+            inicio = time.perf_counter()
+            bcrypt.hashpw(b"calibracao", bcrypt.gensalt(rounds=BCRYPT_CUSTO_MIN))
+            ms = (time.perf_counter() - inicio) * 1000
+            custo = BCRYPT_CUSTO_MIN
+            while custo < BCRYPT_CUSTO_MAX and ms * 2 <= BCRYPT_ALVO_MS:
+                custo += 1
+                ms *= 2
+            _custo_calibrado = custo
+    return _custo_calibrado
+
+def custo_do_hash(hash_armazenado):
+    # Formato: $2b$<custo>$<salt+hash>
+    try:
+        return int(hash_armazenado.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
 def hash_senha(senha_plana):
-    return bcrypt.hashpw(senha_plana.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    salt = bcrypt.gensalt(rounds=calibrar_custo_bcrypt())
+    return bcrypt.hashpw(senha_plana.encode('utf-8'), salt).decode('utf-8')
 
+@perf.medir("verificar_senha")
 def verificar_senha(senha_plana, hash_armazenado):
+    """Retorna (válida, precisa_migrar): migra texto puro e hashes com custo diferente do calibrado."""
     try:
         if bcrypt.checkpw(senha_plana.encode('utf-8'), hash_armazenado.encode('utf-8')):
-            return True, False
+            return True, custo_do_hash(hash_armazenado) != calibrar_custo_bcrypt()
     except (ValueError, TypeError):
         if senha_plana == hash_armazenado:
             return True, True
     return False, False
 
 # PERSISTENCIA
+# Cache compartilhado entre as sessões: só relê o arquivo quando mtime/tamanho mudam
+_cache_usuarios = {"assinatura": None, "usuarios": None}
+_trava_usuarios = threading.Lock()
+
+def _assinatura_usuarios():
+    try:
+        st_arq = os.stat(USUARIOS_FILE)
+        return (st_arq.st_mtime_ns, st_arq.st_size)
+    except FileNotFoundError:
+        return None
+
 def carregar_usuarios():
-    if os.path.exists(USUARIOS_FILE):
-        with open(USUARIOS_FILE, "r") as f: return json.load(f)
-    return {"Admin": "admin2026"}
+    """Retorna uma cópia (quem chama pode alterar o dicionário antes de salvar)."""
+    with _trava_usuarios:
+        assinatura = _assinatura_usuarios()
+        if _cache_usuarios["usuarios"] is None or assinatura != _cache_usuarios["assinatura"]:
+            if assinatura is None:
+                usuarios = {"Admin": "admin2026"}
+            else:
+                with open(USUARIOS_FILE, "r") as f: usuarios = json.load(f)
+            _cache_usuarios.update(assinatura=assinatura, usuarios=usuarios)
+        return dict(_cache_usuarios["usuarios"])
 
 def salvar_usuarios(usuarios):
-    with open(USUARIOS_FILE, "w") as f: json.dump(usuarios, f)
+    # Gravação atômica: uma execução interrompida não trunca o arquivo
+    with _trava_usuarios:
+        gravar_json_atomico(USUARIOS_FILE, usuarios)
+        _cache_usuarios.update(assinatura=_assinatura_usuarios(), usuarios=dict(usuarios))
+
+@contextmanager
+def editar_usuarios():
+    """
+    Leitura-alteração-escrita sob trava do arquivo: alterações feitas ao mesmo
+    tempo por outras sessões (ou processos) não se perdem. Só grava se mudou.
+    """
+    with bloqueio_arquivo(USUARIOS_FILE):
+        users = carregar_usuarios()
+        original = dict(users)
+        yield users
+        if users != original:
+            salvar_usuarios(users)
 
 def excluir_usuario(nome_usuario):
-    users = carregar_usuarios()
-    if nome_usuario in users:
-        del users[nome_usuario]
-        salvar_usuarios(users)
-        return True
-    return False
+    with editar_usuarios() as users:
+        return users.pop(nome_usuario, None) is not None
 
 # FUNÇÕES DE LOGICA
 def alterar_senha(usuario, senha_atual, nova_senha):
-    users = carregar_usuarios()
-    hash_armazenado = users.get(usuario)
-    valido, _ = verificar_senha(senha_atual, hash_armazenado)
+    # bcrypt fora da trava, para não segurar as outras sessões
+    valido, _ = verificar_senha(senha_atual, carregar_usuarios().get(usuario))
     if valido:
-        users[usuario] = hash_senha(nova_senha)
-        salvar_usuarios(users)
+        novo_hash = hash_senha(nova_senha)
+        with editar_usuarios() as users:
+            users[usuario] = novo_hash
         return True
     return False
 
@@ -66,11 +137,12 @@ def tela_login():
                     is_valid, precisa_migrar = verificar_senha(p, u_db[u])
                     if is_valid:
                         if precisa_migrar:
-                            u_db[u] = hash_senha(p)
-                            salvar_usuarios(u_db)
+                            novo_hash = hash_senha(p)
+                            with editar_usuarios() as users:
+                                users[u] = novo_hash
                         
                         st.session_state['usuario_ativo'] = u
-                        st.session_state['db_formularios'] = carregar_dados_locais()
+                        st.session_state['indice_uc'] = IndiceUC(carregar_dados_locais())
                         carregar_modelo_atual()
                         st.rerun()
                     else:
@@ -0,0 +1,245 @@
+import sys
+import io
+import os
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import multiprocessing
+from datetime import datetime
+from PIL import Image
+from openpyxl import load_workbook
+import utils
+import auth
+
+# Benchmark da exportação Excel: compara o preenchimento registro a registro
+# (implementação anterior) com a engine em lote de utils.preencher_modelo.
+# Uso: python benchmark.py [n_registros]
+#      python benchmark.py estresse [escritores] [operacoes]   (gravações concorrentes)
+#      python benchmark.py suite [--tamanhos 100,1000,10000] [--fotos 0.5] [--foto-kb 300] [--saida arq.json]
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Levantamento_Base.xlsx")
+
+
+def gerar_registros(n, semente=42):
+    """Registros sintéticos distribuídos entre as abas do modelo."""
+    rnd = random.Random(semente)
+    wb = load_workbook(TEMPLATE, read_only=True)
+    abas = {aba: [c for c in next(wb[aba].iter_rows(min_row=1, max_row=1, values_only=True)) if c] for aba in wb.sheetnames}
+    wb.close()
+    nomes = list(abas)
+    registros = []
+    for i in range(n):
+        aba = rnd.choice(nomes)
+        uc = f"UC{rnd.randint(1, max(1, n // 50)):05d}"
+        dados = {campo: f"{campo[:6]}-{rnd.randint(0, 999)}" for campo in abas[aba]}
+        dados["Nome da Unidade Consumidora"] = uc
+        registros.append({
+            "id": f"{i:08d}", "cod_instalacao": uc, "tipo_equipamento": aba,
+            "data_hora": "01/01/2026 08:00:00", "dados": dados, "fotos": []
+        })
+    return registros
+
+
+def foto_sintetica(tamanho_kb, semente=0):
+    """JPEG de ruído com aproximadamente 'tamanho_kb' (ruído não comprime)."""
+    rnd = random.Random(semente)
+    lado = max(16, int((tamanho_kb * 1024 / 1.6) ** 0.5))
+    for _ in range(2):
+        img = Image.frombytes("RGB", (lado, lado), rnd.randbytes(lado * lado * 3))
+        saida = io.BytesIO()
+        img.save(saida, format="JPEG", quality=90)
+        # Ajusta o lado uma vez pela razão entre o tamanho obtido e o pedido
+        lado = max(16, int(lado * (tamanho_kb * 1024 / saida.tell()) ** 0.5))
+    return saida.getvalue()
+
+def gerar_levantamento(n, semente=42, fotos_por_registro=0.0, tamanho_foto_kb=300):
+    """
+    Registros sintéticos mais as fotos anexadas a cada um, no formato que a tela
+    de preenchimento entrega a salvar_fotos_local: {índice: [{'arquivo', 'nome'}]}.
+    'fotos_por_registro' é a média (0.5 = uma foto a cada dois registros).
+    """
+    registros = gerar_registros(n, semente)
+    rnd = random.Random(semente)
+    base = foto_sintetica(tamanho_foto_kb, semente) if fotos_por_registro else b""
+    anexos = {}
+    for i in range(n):
+        qtd = int(fotos_por_registro) + (rnd.random() < fotos_por_registro % 1)
+        if qtd:
+            # Bytes extras depois do fim do JPEG deixam cada foto única (sem deduplicação)
+            anexos[i] = [{"arquivo": io.BytesIO(base + f"{i}-{j}".encode()), "nome": f"Foto {j + 1}"} for j in range(qtd)]
+    return registros, anexos
+
+def exportar_legado(lista_registros):
+    """Algoritmo anterior: cabeçalho e ws.max_row recalculados a cada registro."""
+    wb = load_workbook(TEMPLATE)
+    for reg in lista_registros:
+        tipo = reg.get('tipo_equipamento')
+        if tipo in wb.sheetnames:
+            ws = wb[tipo]
+            headers = {ws.cell(row=1, column=i).value: i for i in range(1, ws.max_column + 1)}
+            proxima_fila = ws.max_row + 1
+            for campo, valor in reg.get("dados", {}).items():
+                if campo in headers:
+                    ws.cell(row=proxima_fila, column=headers[campo], value=valor)
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def cronometrar(func, *args):
+    inicio = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - inicio
+
+
+# ESTRESSE DE GRAVAÇÃO CONCORRENTE
+# Vários processos incluem, excluem e atualizam registros na mesma base (com
+# compactações frequentes) e cadastram usuários ao mesmo tempo. No fim, nada
+# pode ter se perdido nem ficado truncado.
+def _escritor(n_escritor, operacoes, base):
+    utils.LIMITE_COMPACTACAO_BYTES = 4 * 1024  # força compactações concorrentes
+    rnd = random.Random(n_escritor)
+    meus = []
+    for i in range(operacoes):
+        reg = {"id": f"w{n_escritor:02d}-{i:05d}", "cod_instalacao": f"UC{rnd.randint(1, 20):03d}",
+               "tipo_equipamento": "Estresse", "data_hora": "01/01/2026 08:00:00", "dados": {"n": i}, "fotos": []}
+        utils.adicionar_registros_locais([reg], base)
+        meus.append(reg)
+        if rnd.random() < 0.2:
+            alvo = meus.pop(rnd.randrange(len(meus)))
+            utils.remover_registros_locais([alvo["id"]], base)
+        elif rnd.random() < 0.2 and meus:
+            alvo = dict(rnd.choice(meus), dados={"n": -1})
+            utils.atualizar_registros_locais([alvo], base)
+        if i % 10 == 0:
+            with auth.editar_usuarios() as users:
+                users[f"tec{n_escritor:02d}_{i:05d}"] = "x"
+    return sorted(r["id"] for r in meus)
+
+def estresse(escritores=8, operacoes=200):
+    pasta = tempfile.mkdtemp(prefix="poup_estresse_")
+    os.chdir(pasta)
+    base = "dados_Estresse.json"
+    inicio = time.perf_counter()
+    with multiprocessing.Pool(escritores) as pool:
+        esperados = pool.starmap(_escritor, [(n, operacoes, base) for n in range(escritores)])
+    duracao = time.perf_counter() - inicio
+
+    ids = sorted(r["id"] for r in utils.carregar_dados_locais(base))
+    ids_esperados = sorted(i for lista in esperados for i in lista)
+    usuarios = auth.carregar_usuarios()
+    usuarios_esperados = escritores * len(range(0, operacoes, 10))
+    print(f"{escritores} escritores x {operacoes} operações em {duracao:.2f}s ({pasta})")
+    print(f"  registros: {len(ids)} gravados, {len(ids_esperados)} esperados -> {'OK' if ids == ids_esperados else 'DIVERGÊNCIA'}")
+    print(f"  usuários:  {len(usuarios) - 1} gravados, {usuarios_esperados} esperados -> {'OK' if len(usuarios) - 1 == usuarios_esperados else 'DIVERGÊNCIA'}")
+    return ids == ids_esperados and len(usuarios) - 1 == usuarios_esperados
+
+
+# SUÍTE DE DESEMPENHO
+# Mede tempo e pico de memória (alocações Python, via tracemalloc) das funções
+# principais em vários tamanhos, sem Streamlit rodando. Tempo e memória vêm de
+# passadas separadas (tracemalloc deixa o código bem mais lento), cada uma numa
+# pasta de trabalho nova. O resultado vai para um JSON comparável entre versões.
+FUNCOES_SUITE = ["salvar_fotos_local", "salvar_dados_locais", "carregar_dados_locais",
+                 "analisar_modelo_excel", "exportar_para_excel", "gerar_zip_exportacao"]
+
+def _etapas(n, registros, anexos, modelo_bytes):
+    """Gera (nome, função sem argumentos) na ordem do fluxo real do app."""
+    base = "dados_Benchmark.json"
+    def fotos():
+        for i, lista in anexos.items():
+            for item in lista: item["arquivo"].seek(0)
+            registros[i]["fotos"] = utils.salvar_fotos_local(lista, registros[i]["cod_instalacao"])
+    yield "salvar_fotos_local", fotos
+    yield "salvar_dados_locais", lambda: utils.salvar_dados_locais(registros, base)
+    yield "carregar_dados_locais", lambda: utils.carregar_dados_locais(base)
+    yield "analisar_modelo_excel", lambda: utils.analisar_modelo_excel(modelo_bytes)
+    yield "exportar_para_excel", lambda: utils.exportar_para_excel(registros, TEMPLATE)
+    yield "gerar_zip_exportacao", lambda: utils.gerar_zip_exportacao(registros, modelo_bytes=modelo_bytes)
+
+def _passada(n, args, modelo_bytes, memoria):
+    registros, anexos = gerar_levantamento(n, fotos_por_registro=args.fotos, tamanho_foto_kb=args.foto_kb)
+    pasta = tempfile.mkdtemp(prefix="poup_suite_")
+    anterior = os.getcwd()
+    os.chdir(pasta)
+    medidas = {}
+    try:
+        for nome, etapa in _etapas(n, registros, anexos, modelo_bytes):
+            if memoria:
+                tracemalloc.start()
+                etapa()
+                medidas[nome] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+            else:
+                inicio = time.perf_counter()
+                etapa()
+                medidas[nome] = time.perf_counter() - inicio
+    finally:
+        os.chdir(anterior)
+        shutil.rmtree(pasta, ignore_errors=True)
+    return medidas
+
+def _versao_codigo():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def suite(argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py suite", description="Tempo e pico de memória por função e tamanho.")
+    parser.add_argument("--tamanhos", default="100,1000,10000", help="quantidades de registros, separadas por vírgula")
+    parser.add_argument("--fotos", type=float, default=0.2, help="média de fotos por registro")
+    parser.add_argument("--foto-kb", type=int, default=300, help="tamanho de cada foto sintética (KB)")
+    parser.add_argument("--saida", default=f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json", help="arquivo JSON de resultados")
+    args = parser.parse_args(argv)
+
+    # Fora do 'streamlit run' o Streamlit avisa a cada acesso ao session_state
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    with open(TEMPLATE, "rb") as f: modelo_bytes = f.read()
+    saida = os.path.abspath(args.saida)
+
+    resultados = []
+    for n in [int(t) for t in args.tamanhos.split(",")]:
+        tempos = _passada(n, args, modelo_bytes, memoria=False)
+        picos = _passada(n, args, modelo_bytes, memoria=True)
+        print(f"{n} registros")
+        for nome in FUNCOES_SUITE:
+            resultados.append({"registros": n, "funcao": nome, "segundos": round(tempos[nome], 4), "pico_mb": round(picos[nome], 2)})
+            print(f"  {nome:<24} {tempos[nome]:>9.3f}s {picos[nome]:>10.1f} MB")
+
+    relatorio = {
+        "versao": _versao_codigo(), "data": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(), "plataforma": platform.platform(),
+        "parametros": {"tamanhos": args.tamanhos, "fotos_por_registro": args.fotos, "foto_kb": args.foto_kb,
+                       "recomprimir_fotos": utils.FOTO_RECOMPRIMIR, "backend": utils.BACKEND_DADOS},
+        "resultados": resultados,
+    }
+    with open(saida, "w") as f: json.dump(relatorio, f, indent=2, ensure_ascii=False)
+    print(f"Resultados em {saida}")
+
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "suite":
+    suite(sys.argv[2:])
+    sys.exit(0)
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "estresse":
+    args = [int(a) for a in sys.argv[2:4]]
+    sys.exit(0 if estresse(*args) else 1)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    registros = gerar_registros(n)
+    t_legado = cronometrar(exportar_legado, registros)
+    t_lote = cronometrar(utils.exportar_para_excel, registros, TEMPLATE)
+    print(f"{n} registros")
+    print(f"  registro a registro: {t_legado:.2f}s")
+    print(f"  engine em lote:      {t_lote:.2f}s")
+    print(f"  ganho:               {t_legado / t_lote:.1f}x")
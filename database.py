@@ -0,0 +1,148 @@
+import sqlite3
+import json
+import os
+import threading
+from datetime import datetime
+
+# Backend SQLite opcional para os registros de levantamento.
+# Cada registro pertence a uma "origem" (o caminho dados_<user>.json do técnico),
+# de modo que a mesma API de carregar/salvar/excluir continua valendo. O ID é
+# único dentro da origem: a mesma base copiada para outra origem não move registros.
+SQLITE_PATH = os.environ.get("POUP_SQLITE_PATH", "levantamentos.db")
+
+_local = threading.local()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registros (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL,
+    origem TEXT NOT NULL,
+    cod_instalacao TEXT,
+    tipo_equipamento TEXT,
+    data_hora TEXT,
+    qtd_fotos INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    UNIQUE(origem, id)
+);
+CREATE INDEX IF NOT EXISTS idx_registros_uc ON registros(origem, cod_instalacao);
+CREATE INDEX IF NOT EXISTS idx_registros_tipo ON registros(origem, tipo_equipamento);
+CREATE INDEX IF NOT EXISTS idx_registros_data ON registros(origem, data_hora);
+"""
+
+def conectar():
+    """Uma conexão por thread (cada sessão do Streamlit roda na sua)."""
+    con = getattr(_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(SQLITE_PATH, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(SCHEMA)
+        _local.con = con
+    return con
+
+def _data_iso(data_hora):
+    """Converte 'dd/mm/aaaa HH:MM[:SS]' para um formato ordenável pelo índice."""
+    for fmt in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M"):
+        try:
+            return datetime.strptime(data_hora, fmt).strftime("%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError):
+            continue
+    return data_hora
+
+def _uc_do_registro(reg):
+    return reg.get('cod_instalacao') or reg.get('dados', {}).get('Nome da Unidade Consumidora', 'UC Indefinida')
+
+def _linha(origem, reg):
+    return (
+        reg['id'], origem, _uc_do_registro(reg), reg.get('tipo_equipamento'),
+        _data_iso(reg.get('data_hora')), len(reg.get('fotos', [])), json.dumps(reg)
+    )
+
+SQL_UPSERT = """
+INSERT INTO registros (id, origem, cod_instalacao, tipo_equipamento, data_hora, qtd_fotos, payload)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(origem, id) DO UPDATE SET
+    cod_instalacao = excluded.cod_instalacao,
+    tipo_equipamento = excluded.tipo_equipamento, data_hora = excluded.data_hora,
+    qtd_fotos = excluded.qtd_fotos, payload = excluded.payload
+"""
+
+# ESCRITA
+def gravar(origem, registros):
+    """Insere registros novos ou atualiza os existentes (mesmo ID) sem mudar a ordem."""
+    con = conectar()
+    with con:
+        con.executemany(SQL_UPSERT, [_linha(origem, reg) for reg in registros])
+
+def atualizar(origem, registros):
+    """Atualiza só registros que ainda existem (não recria excluídos)."""
+    con = conectar()
+    with con:
+        con.executemany("""
+            UPDATE registros SET cod_instalacao = ?, tipo_equipamento = ?, data_hora = ?, qtd_fotos = ?, payload = ?
+            WHERE id = ? AND origem = ?
+        """, [linha[2:] + linha[:2] for linha in (_linha(origem, reg) for reg in registros)])
+
+def substituir(origem, registros):
+    con = conectar()
+    with con:
+        con.execute("DELETE FROM registros WHERE origem = ?", (origem,))
+        con.executemany(SQL_UPSERT, [_linha(origem, reg) for reg in registros])
+
+def remover(origem, ids):
+    con = conectar()
+    with con:
+        con.executemany("DELETE FROM registros WHERE origem = ? AND id = ?", [(origem, i) for i in ids])
+
+def excluir_origem(origem):
+    substituir(origem, [])
+
+# CONSULTAS
+def carregar(origem):
+    cur = conectar().execute("SELECT payload FROM registros WHERE origem = ? ORDER BY seq", (origem,))
+    return [json.loads(p) for (p,) in cur]
+
+def listar_origens():
+    return [o for (o,) in conectar().execute("SELECT DISTINCT origem FROM registros")]
+
+def registros_por_tipo(origem):
+    """Registros já ordenados por tipo de equipamento (aba do Excel)."""
+    cur = conectar().execute(
+        "SELECT payload FROM registros WHERE origem = ? ORDER BY tipo_equipamento, seq", (origem,))
+    return [json.loads(p) for (p,) in cur]
+
+def metadados(origem):
+    """
+    Contagens da origem. 'tamanho' soma os payloads da origem (o arquivo .db é
+    compartilhado entre os técnicos) e 'modificado' é a data do registro mais
+    recente, já que o banco não guarda quando cada linha foi alterada.
+    """
+    qtd, ucs, ultima, tamanho = conectar().execute(
+        "SELECT COUNT(*), COUNT(DISTINCT cod_instalacao), MAX(data_hora), COALESCE(SUM(LENGTH(payload)), 0) FROM registros WHERE origem = ?",
+        (origem,)).fetchone()
+    import utils  # aqui: utils importa este módulo
+    try:
+        # data_hora é gravada no horário de Brasília, não no fuso do servidor
+        fuso_br = utils.get_data_hora_br().tzinfo
+        modificado = datetime.strptime(ultima, "%Y-%m-%d %H:%M:%S").replace(tzinfo=fuso_br).timestamp() if ultima else 0
+    except ValueError:
+        modificado = 0
+    return {"registros": qtd, "ucs": ucs, "tamanho": tamanho, "modificado": modificado}
+
+def previa(origem, limite=None):
+    sql = """SELECT cod_instalacao, tipo_equipamento, json_extract(payload, '$.data_hora')
+             FROM registros WHERE origem = ? ORDER BY seq"""
+    params = (origem,)
+    if limite:
+        sql += " LIMIT ?"
+        params = (origem, limite)
+    return [{"UC": uc, "Tipo": tipo, "Data": data} for uc, tipo, data in conectar().execute(sql, params)]
+
+
+if __name__ == "__main__":
+    # Migração única: python database.py [dados_*.json ...]
+    import sys
+    import utils
+    resultado = utils.migrar_json_para_sqlite(sys.argv[1:] or None)
+    for arquivo, qtd in resultado.items():
+        print(f"{arquivo}: {qtd} registro(s) migrado(s)")
@@ -2,6 +2,8 @@ import streamlit as st
 import styles
 import auth
 import views
+import outbox
+import perf
 
 # configuração da pagina
 st.set_page_config(page_title="Levantamento de Cargas", layout="wide", page_icon="⚡")
@@ -9,6 +11,9 @@ st.set_page_config(page_title="Levantamento de Cargas", layout="wide", page_icon
 # aplicar estilos
 styles.apply_custom_style()
 
+# caixa de saída de emails (retoma envios pendentes após reinício)
+outbox.iniciar_trabalhador()
+
 # inicializar session state
 if 'usuario_ativo' not in st.session_state: st.session_state['usuario_ativo'] = None
 if 'form_id' not in st.session_state: st.session_state['form_id'] = 0
@@ -30,7 +35,7 @@ with st.sidebar:
     st.divider()
     
     # opções limpas
-    opts = ["Configurar Modelo", "Preenchimento", "Exportar & Listar"]
+    opts = ["Configurar Modelo", "Preenchimento", "Exportar & Listar", "Análise de Consumo"]
     if st.session_state['usuario_ativo'] == "Admin": opts.append("Painel Admin")
     
     menu = st.radio("Navegação", opts)
@@ -40,6 +45,9 @@ with st.sidebar:
         st.session_state['usuario_ativo'] = None
         st.rerun()
 
+# amostras de desempenho desta execução ficam em nome do usuário
+perf.definir_usuario(st.session_state['usuario_ativo'])
+
 # roteamento de paginas
 if menu == "Configurar Modelo":
     views.render_configurar_modelo()
@@ -47,5 +55,7 @@ elif menu == "Preenchimento":
     views.render_preenchimento()
 elif menu == "Exportar & Listar":
     views.render_exportar_listar()
+elif menu == "Análise de Consumo":
+    views.render_analise()
 elif menu == "Painel Admin":
     views.render_admin_panel()
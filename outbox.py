@@ -0,0 +1,295 @@
+import os
+import json
+import uuid
+import time
+import shutil
+import smtplib
+import base64
+import threading
+from email.header import Header
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+# Caixa de saída de emails: cada envio vira um arquivo JSON em disco (com a cópia
+# do anexo ao lado) e uma thread em segundo plano processa a fila, reaproveitando
+# a conexão SMTP autenticada entre mensagens e reagendando falhas com espera
+# exponencial. Sobrevive a reinícios do servidor: o que ficou pendente é retomado.
+# O anexo é codificado em base64 direto do disco, em blocos, durante o DATA; pacotes
+# acima do limite do provedor saem em volumes numerados (.001, .002...), um por email.
+
+# CONFIGURAÇÃO (variáveis de ambiente da implantação)
+PASTA_CAIXA_SAIDA = os.environ.get("POUP_CAIXA_SAIDA", "caixa_saida")
+SMTP_HOST = os.environ.get("POUP_SMTP_HOST", "smtp.gmail.com")
+SMTP_PORTA = int(os.environ.get("POUP_SMTP_PORTA", "587"))
+SMTP_USUARIO = os.environ.get("POUP_SMTP_USUARIO", "")
+SMTP_SENHA = os.environ.get("POUP_SMTP_SENHA", "")
+SMTP_REMETENTE = os.environ.get("POUP_SMTP_REMETENTE", SMTP_USUARIO)
+SMTP_STARTTLS = os.environ.get("POUP_SMTP_STARTTLS", "1").lower() in ("1", "true", "sim")
+SMTP_TIMEOUT = 60
+
+# Limite do anexo por mensagem, antes do base64 (que acrescenta ~37%)
+LIMITE_ANEXO_BYTES = int(float(os.environ.get("POUP_EMAIL_LIMITE_MB", "18")) * 1024 * 1024)
+BLOCO_BASE64 = 57 * 1024   # múltiplo de 57 bytes: cada bloco vira linhas completas de 76 caracteres
+
+MAX_TENTATIVAS = 5
+ESPERA_BASE_S = 5          # 5s, 10s, 20s, 40s...
+ESPERA_MAX_S = 600
+CONEXAO_OCIOSA_S = 120     # fecha a conexão reaproveitada depois desse tempo sem envios
+RETENCAO_FINALIZADOS_S = 24 * 3600  # enviados e falhos: registro e anexo somem depois disso
+
+# Estados de um envio
+PENDENTE, ENVIANDO, ENVIADO, FALHOU = "pendente", "enviando", "enviado", "falhou"
+
+_trava = threading.Lock()
+_acordar = threading.Event()
+_trabalhador = None
+_ao_enviar = []
+
+def ao_enviar(funcao):
+    """Registra funcao(envio), chamada pelo trabalhador quando um envio é concluído."""
+    _ao_enviar.append(funcao)
+    return funcao
+
+# PERSISTÊNCIA DA FILA
+def _caminho_envio(id_envio):
+    return os.path.join(PASTA_CAIXA_SAIDA, f"{id_envio}.json")
+
+def _caminho_anexo(id_envio):
+    return os.path.join(PASTA_CAIXA_SAIDA, f"{id_envio}.anexo")
+
+def _gravar_envio(envio):
+    import utils  # aqui: utils importa este módulo
+    # Troca atômica: a UI nunca lê um JSON pela metade
+    utils.gravar_json_atomico(_caminho_envio(envio["id"]), envio)
+
+def estado_envio(id_envio):
+    """Registro do envio (status, tentativas, erro...) ou None se não existir."""
+    try:
+        with open(_caminho_envio(id_envio), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _listar_envios():
+    if not os.path.isdir(PASTA_CAIXA_SAIDA):
+        return []
+    envios = []
+    for nome in os.listdir(PASTA_CAIXA_SAIDA):
+        if nome.endswith(".json"):
+            envio = estado_envio(nome[:-5])
+            if envio: envios.append(envio)
+    return sorted(envios, key=lambda e: e["criado_em"])
+
+def enfileirar_email(destinatario, assunto, corpo, arquivo, nome_anexo, mime="application/octet-stream", entrega=None):
+    """
+    Copia o anexo (objeto de arquivo) para a caixa de saída, registra o envio e
+    acorda o trabalhador. Retorna o ID para acompanhar com estado_envio().
+    'entrega' (dict serializável) acompanha o envio até os callbacks de ao_enviar.
+    """
+    os.makedirs(PASTA_CAIXA_SAIDA, exist_ok=True)
+    id_envio = uuid.uuid4().hex
+    arquivo.seek(0)
+    with open(_caminho_anexo(id_envio), "wb") as destino:
+        shutil.copyfileobj(arquivo, destino, 1024 * 1024)
+        tamanho = destino.tell()
+    _gravar_envio({
+        "id": id_envio, "destinatario": destinatario, "assunto": assunto, "corpo": corpo,
+        "nome_anexo": nome_anexo, "mime": mime,
+        "tamanho": tamanho, "partes": max(1, -(-tamanho // LIMITE_ANEXO_BYTES)), "partes_enviadas": 0,
+        "status": PENDENTE, "tentativas": 0, "proxima_tentativa": 0, "erro": None,
+        "criado_em": time.time(), "enviado_em": None, "finalizado_em": None, "entrega": entrega,
+    })
+    iniciar_trabalhador()
+    _acordar.set()
+    return id_envio
+
+def erro_configuracao():
+    """Mensagem do que falta na configuração SMTP, ou None se está completa."""
+    if not SMTP_REMETENTE:
+        return "SMTP não configurado: defina POUP_SMTP_USUARIO e POUP_SMTP_SENHA (ou POUP_SMTP_REMETENTE sem autenticação)."
+    if SMTP_USUARIO and not SMTP_SENHA:
+        return "SMTP não configurado: POUP_SMTP_SENHA não definida para POUP_SMTP_USUARIO."
+    return None
+
+# ENVIO
+def _dados_parte(envio, parte):
+    """Assunto, corpo e nome do anexo da parte (0-based); volumes só quando há mais de uma."""
+    total = envio["partes"]
+    if total == 1:
+        return envio["assunto"], envio["corpo"], envio["nome_anexo"]
+    corpo = (f"{envio['corpo']}\n\nParte {parte + 1} de {total}. Baixe todas as partes e junte-as "
+             f"antes de abrir (7-Zip abre direto o .001; ou: cat {envio['nome_anexo']}.* > {envio['nome_anexo']}"
+             f" / copy /b {envio['nome_anexo']}.001+{envio['nome_anexo']}.002... {envio['nome_anexo']}).")
+    return f"{envio['assunto']} (parte {parte + 1}/{total})", corpo, f"{envio['nome_anexo']}.{parte + 1:03d}"
+
+def _cabecalho_mensagem(envio, assunto, corpo, nome_anexo, fronteira):
+    texto = MIMEText(corpo, 'plain', 'utf-8')
+    linhas = [
+        f"From: {SMTP_REMETENTE}",
+        f"To: {envio['destinatario']}",
+        f"Subject: {Header(assunto, 'utf-8').encode()}",
+        f"Date: {formatdate(localtime=True)}",
+        f"Message-ID: {make_msgid()}",
+        "MIME-Version: 1.0",
+        f'Content-Type: multipart/mixed; boundary="{fronteira}"',
+        "",
+        f"--{fronteira}",
+        texto.as_string(),
+        f"--{fronteira}",
+        f'Content-Type: {envio["mime"]}; name="{nome_anexo}"',
+        "Content-Transfer-Encoding: base64",
+        f'Content-Disposition: attachment; filename="{nome_anexo}"',
+        "", "",
+    ]
+    return "\r\n".join(l.replace("\r\n", "\n").replace("\n", "\r\n") for l in linhas).encode("utf-8")
+
+def _enviar_parte(smtp, envio, parte):
+    """
+    Envia uma mensagem com o trecho [parte * limite, +limite) do anexo, montando o
+    MIME à mão sobre MAIL/RCPT/DATA: o base64 sai em blocos lidos do disco, sem
+    manter o anexo (nem a mensagem codificada) inteiro em memória.
+    """
+    assunto, corpo, nome_anexo = _dados_parte(envio, parte)
+    inicio = parte * LIMITE_ANEXO_BYTES
+    restante = min(LIMITE_ANEXO_BYTES, envio["tamanho"] - inicio)
+    fronteira = f"=_poup_{uuid.uuid4().hex}"
+
+    smtp.ehlo_or_helo_if_needed()
+    opcoes = [f"SIZE={restante * 4 // 3 + 4096}"] if smtp.has_extn("size") else []
+    codigo, resp = smtp.mail(SMTP_REMETENTE, opcoes)
+    if codigo != 250:
+        raise smtplib.SMTPSenderRefused(codigo, resp, SMTP_REMETENTE)
+    codigo, resp = smtp.rcpt(envio["destinatario"])
+    if codigo not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({envio["destinatario"]: (codigo, resp)})
+    smtp.putcmd("data")
+    codigo, resp = smtp.getreply()
+    if codigo != 354:
+        raise smtplib.SMTPDataError(codigo, resp)
+
+    # Nenhuma linha começa com "." (cabeçalhos nossos, texto e anexo em base64): sem dot-stuffing
+    smtp.send(_cabecalho_mensagem(envio, assunto, corpo, nome_anexo, fronteira))
+    with open(_caminho_anexo(envio["id"]), "rb") as f:
+        f.seek(inicio)
+        while restante > 0:
+            bloco = f.read(min(BLOCO_BASE64, restante))
+            if not bloco:
+                break
+            restante -= len(bloco)
+            smtp.send(base64.encodebytes(bloco).replace(b"\n", b"\r\n"))
+    smtp.send(f"\r\n--{fronteira}--\r\n.\r\n".encode("ascii"))
+    codigo, resp = smtp.getreply()
+    if codigo != 250:
+        raise smtplib.SMTPDataError(codigo, resp)
+
+class ConexaoSMTP:
+    """Conexão autenticada reaproveitada entre mensagens; reabre se o servidor a derrubar."""
+    def __init__(self):
+        self.smtp = None
+        self.ultimo_uso = 0
+
+    def obter(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                self.fechar()
+        if self.smtp is None:
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORTA, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_USUARIO:
+                smtp.login(SMTP_USUARIO, SMTP_SENHA)
+            self.smtp = smtp
+        self.ultimo_uso = time.time()
+        return self.smtp
+
+    def fechar(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def fechar_se_ociosa(self):
+        if self.smtp is not None and time.time() - self.ultimo_uso > CONEXAO_OCIOSA_S:
+            self.fechar()
+
+def _processar(envio, conexao):
+    erro = erro_configuracao()
+    if erro:
+        # Sem credenciais não adianta tentar de novo
+        envio.update(status=FALHOU, erro=erro, finalizado_em=time.time())
+        _gravar_envio(envio)
+        return
+    envio["status"] = ENVIANDO
+    envio["tentativas"] += 1
+    _gravar_envio(envio)
+    try:
+        # Retomada parte a parte: volumes já entregues não são reenviados
+        while envio["partes_enviadas"] < envio["partes"]:
+            _enviar_parte(conexao.obter(), envio, envio["partes_enviadas"])
+            envio["partes_enviadas"] += 1
+            _gravar_envio(envio)
+    except Exception as e:
+        # Conexão em estado desconhecido: a próxima tentativa abre outra
+        conexao.fechar()
+        envio["erro"] = f"{type(e).__name__}: {e}"
+        if envio["tentativas"] >= MAX_TENTATIVAS:
+            envio.update(status=FALHOU, finalizado_em=time.time())
+        else:
+            envio["status"] = PENDENTE
+            espera = min(ESPERA_BASE_S * 2 ** (envio["tentativas"] - 1), ESPERA_MAX_S)
+            envio["proxima_tentativa"] = time.time() + espera
+        _gravar_envio(envio)
+        return
+    envio.update(status=ENVIADO, erro=None, enviado_em=time.time(), finalizado_em=time.time())
+    _gravar_envio(envio)
+    _remover_arquivos(envio["id"], manter_registro=True)
+    for funcao in _ao_enviar:
+        try:
+            funcao(envio)
+        except Exception as e:
+            print(f"caixa de saída: falha no pós-envio de {envio['id']}: {e}")
+
+def _remover_arquivos(id_envio, manter_registro=False):
+    caminhos = [_caminho_anexo(id_envio)] if manter_registro else [_caminho_anexo(id_envio), _caminho_envio(id_envio)]
+    for caminho in caminhos:
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+def _laco_trabalhador():
+    conexao = ConexaoSMTP()
+    # Envios interrompidos no meio por um reinício voltam para a fila
+    for envio in _listar_envios():
+        if envio["status"] == ENVIANDO:
+            envio["status"] = PENDENTE
+            _gravar_envio(envio)
+    while True:
+        _acordar.clear()
+        agora = time.time()
+        proxima = None
+        for envio in _listar_envios():
+            if envio["status"] in (ENVIADO, FALHOU):
+                if agora - envio["finalizado_em"] > RETENCAO_FINALIZADOS_S:
+                    _remover_arquivos(envio["id"])
+            if envio["status"] != PENDENTE:
+                continue
+            if envio["proxima_tentativa"] <= agora:
+                _processar(envio, conexao)
+            elif proxima is None or envio["proxima_tentativa"] < proxima:
+                proxima = envio["proxima_tentativa"]
+        conexao.fechar_se_ociosa()
+        espera = CONEXAO_OCIOSA_S if proxima is None else max(0.0, proxima - time.time())
+        _acordar.wait(min(espera, CONEXAO_OCIOSA_S))
+
+def iniciar_trabalhador():
+    """Sobe a thread da caixa de saída (uma por processo); retoma pendências do disco."""
+    global _trabalhador
+    with _trava:
+        if _trabalhador is None or not _trabalhador.is_alive():
+            _trabalhador = threading.Thread(target=_laco_trabalhador, name="caixa-saida", daemon=True)
+            _trabalhador.start()
@@ -0,0 +1,50 @@
+import os
+import time
+import threading
+import functools
+from collections import deque
+
+# Medição de tempo por rerun: renderizadores das páginas e chamadas pesadas
+# (modelo, exportação, bcrypt, leitura/gravação da base). Só fica ativa com
+# POUP_PERF=1; desligada, medir() devolve a própria função (custo zero).
+ATIVO = os.environ.get("POUP_PERF", "").lower() in ("1", "true", "sim")
+LIMITE_AMOSTRAS = int(os.environ.get("POUP_PERF_AMOSTRAS", "10000"))
+
+# Buffer circular compartilhado entre as sessões: as mais antigas saem primeiro
+_amostras = deque(maxlen=LIMITE_AMOSTRAS)
+_trava = threading.Lock()
+_local = threading.local()
+
+def definir_usuario(usuario):
+    """Usuário atribuído às amostras da thread atual (cada sessão roda na sua)."""
+    _local.usuario = usuario
+
+def registrar(operacao, segundos):
+    amostra = (time.time(), getattr(_local, "usuario", None) or "-", operacao, segundos)
+    with _trava:
+        _amostras.append(amostra)
+
+def medir(operacao):
+    """Decorador que registra a duração de cada chamada como 'operacao'."""
+    def decorador(func):
+        if not ATIVO: return func
+
+        @functools.wraps(func)
+        def medida(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                # Também mede chamadas interrompidas (st.rerun, st.stop, erro)
+                registrar(operacao, time.perf_counter() - inicio)
+        return medida
+    return decorador
+
+def amostras():
+    """Cópia das amostras: lista de (momento, usuario, operacao, segundos)."""
+    with _trava:
+        return list(_amostras)
+
+def limpar():
+    with _trava:
+        _amostras.clear()
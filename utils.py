@@ -3,21 +3,40 @@ import pandas as pd
 import io
 import json
 import os
-import smtplib
 import zipfile
 import shutil
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
+import uuid
+import hashlib
+import time
+import threading
+import tempfile
+import atexit
+import multiprocessing
+try:
+    import fcntl
+except ImportError:  # Windows: só a trava entre threads do processo
+    fcntl = None
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from xml.etree import ElementTree
 from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.utils.datetime import from_excel
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from PIL import Image, ImageOps
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
 from openpyxl import load_workbook
 import io
+import database
+import outbox
+import analise
+import perf
 
 
-def exportar_para_excel(lista_registros):
+@perf.medir("exportar_para_excel")
+def exportar_para_excel(lista_registros, template_path="Levantamento_Base.xlsx"):
     """
     Usa o arquivo Levantamento_Base.xlsx como template e insere os dados
     preservando a formatação original.
@@ -25,50 +44,63 @@ def exportar_para_excel(lista_registros):
     if not lista_registros:
         return None
 
-    # 1. Caminho do seu modelo original
-    template_path = "Levantamento_Base.xlsx"
-    
     if not os.path.exists(template_path):
         st.error("Arquivo template 'Levantamento_Base.xlsx' não encontrado!")
         return None
 
-    # 2. Carregar o workbook (modelo)
     wb = load_workbook(template_path)
-    
-    # 3. Mapear os dados para as abas
-    for reg in lista_registros:
-        tipo = reg.get('tipo_equipamento')
-        if tipo in wb.sheetnames:
-            ws = wb[tipo]
-            
-            # Identificar os cabeçalhos da planilha para saber em qual coluna colar cada dado
-            headers = {ws.cell(row=1, column=i).value: i for i in range(1, ws.max_column + 1)}
-            
-            # Preparar a linha de dados
-            proxima_fila = ws.max_row + 1
-            
-            # Preencher dados do formulário (incluindo Localização que agora está em 'dados')
-            dados_tecnicos = reg.get("dados", {})
-            
-            # Fallback para UC caso venha do legado
-            if "Nome da Unidade Consumidora" not in dados_tecnicos and "cod_instalacao" in reg:
-                dados_tecnicos["Nome da Unidade Consumidora"] = reg["cod_instalacao"]
-                
-            for campo, valor in dados_tecnicos.items():
-                if campo in headers:
-                    ws.cell(row=proxima_fila, column=headers[campo], value=valor)
-            
-            # Adicionar nomes das fotos na última coluna ou onde houver campo 'Fotos'
-            if "Fotos" in headers:
-                fotos = reg.get("fotos", [])
-                nomes_fotos = ", ".join([f['nome_exportacao'] for f in fotos])
-                ws.cell(row=proxima_fila, column=headers["Fotos"], value=nomes_fotos)
+    preencher_modelo(wb, lista_registros)
 
-    # 4. Salvar o resultado em um buffer
     output = io.BytesIO()
     wb.save(output)
     return output.getvalue()
 
+# ENGINE DE PREENCHIMENTO DO MODELO (usada pelo Excel avulso e pelo ZIP)
+# Agrupa os registros por aba uma única vez, lê o cabeçalho de cada aba uma
+# única vez e grava as linhas em lote com ws.append, que continua a partir da
+# última linha do modelo sem recalcular ws.max_row a cada registro.
+def mapa_cabecalhos(ws):
+    return {cell.value: cell.column for cell in ws[1] if cell.value is not None}
+
+def _linha_registro(registro, mapa, largura):
+    linha = [None] * largura
+    dados = registro.get("dados", {})
+    for campo, valor in dados.items():
+        col = mapa.get(campo)
+        if col: linha[col - 1] = valor
+
+    # Fallback para UC caso venha do legado
+    col_uc = mapa.get("Nome da Unidade Consumidora")
+    if col_uc and "Nome da Unidade Consumidora" not in dados and "cod_instalacao" in registro:
+        linha[col_uc - 1] = registro["cod_instalacao"]
+
+    # Nomes das fotos onde houver campo 'Fotos'
+    col_fotos = mapa.get("Fotos")
+    if col_fotos and registro.get("fotos"):
+        linha[col_fotos - 1] = ", ".join(f['nome_exportacao'] for f in registro["fotos"])
+    return linha
+
+def preparar_linhas_por_aba(dados_lista, mapas):
+    """Converte registros em linhas prontas, agrupadas pela aba de destino."""
+    larguras = {aba: max(mapa.values(), default=0) for aba, mapa in mapas.items()}
+    linhas = defaultdict(list)
+    for registro in dados_lista:
+        aba = registro.get("tipo_equipamento")
+        mapa = mapas.get(aba)
+        if mapa is not None:
+            linhas[aba].append(_linha_registro(registro, mapa, larguras[aba]))
+    return linhas
+
+def escrever_linhas(book, linhas_por_aba):
+    for aba, linhas in linhas_por_aba.items():
+        ws = book[aba]
+        for linha in linhas:
+            ws.append(linha)
+
+def preencher_modelo(book, dados_lista):
+    mapas = {aba: mapa_cabecalhos(book[aba]) for aba in book.sheetnames}
+    escrever_linhas(book, preparar_linhas_por_aba(dados_lista, mapas))
+
 # Constantes
 PLANILHA_PADRAO_ADMIN = "Levantamento_Base.xlsx"
 PASTA_FOTOS = "fotos_uploads"
@@ -77,6 +109,18 @@ PASTA_FOTOS = "fotos_uploads"
 if not os.path.exists(PASTA_FOTOS):
     os.makedirs(PASTA_FOTOS)
 
+# CONFIGURAÇÃO (variáveis de ambiente da implantação)
+BACKEND_DADOS = os.environ.get("POUP_BACKEND", "json").lower()
+EXPORTACAO_STREAMING = os.environ.get("POUP_EXPORTACAO_STREAMING", "0").lower() in ("1", "true", "sim")
+
+# Fotos: redução e recompressão na entrada (desligável por implantação)
+FOTO_RECOMPRIMIR = os.environ.get("POUP_FOTO_RECOMPRIMIR", "1").lower() in ("1", "true", "sim")
+FOTO_LADO_MAX = int(os.environ.get("POUP_FOTO_LADO_MAX", "2048"))
+FOTO_QUALIDADE_JPEG = int(os.environ.get("POUP_FOTO_QUALIDADE", "82"))
+
+def usar_sqlite():
+    return BACKEND_DADOS == "sqlite"
+
 # DATAS E CAMINHOS
 def get_data_hora_br():
     fuso_br = timezone(timedelta(hours=-3))
@@ -89,6 +133,13 @@ def get_user_data_path(nome_usuario=None):
         return f"dados_{nome_limpo}.json"
     return None
 
+def get_user_entregas_path(nome_usuario=None):
+    user = nome_usuario if nome_usuario else st.session_state.get('usuario_ativo')
+    if user:
+        nome_limpo = "".join(filter(str.isalnum, user))
+        return f"entregas_{nome_limpo}.json"
+    return None
+
 def get_user_template_path(nome_usuario=None):
     user = nome_usuario if nome_usuario else st.session_state.get('usuario_ativo')
     if user:
@@ -96,17 +147,502 @@ def get_user_template_path(nome_usuario=None):
         return f"template_{nome_limpo}.xlsx"
     return None
 
+# ESCRITA ATÔMICA E TRAVAS DE ARQUIVO
+# Arquivos são gravados num temporário da mesma pasta e trocados com os.replace:
+# quem lê vê a versão antiga ou a nova, nunca um arquivo truncado. Ciclos de
+# leitura-alteração-escrita rodam sob uma trava exclusiva (flock em <arquivo>.lock),
+# que vale entre sessões, threads e processos; é reentrante na mesma thread.
+_travas_locais = defaultdict(threading.Lock)   # processo sem fcntl
+_travas_mantidas = threading.local()
+
+@contextmanager
+def escrita_atomica(path, modo="w"):
+    pasta = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=pasta)
+    try:
+        with os.fdopen(fd, modo) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp): os.remove(temp)
+        raise
+
+def gravar_json_atomico(path, dados):
+    # json.dumps usa o codificador em C; json.dump em arquivo cai no caminho em Python
+    with escrita_atomica(path) as f: f.write(json.dumps(dados))
+
+@contextmanager
+def bloqueio_arquivo(path):
+    mantidas = getattr(_travas_mantidas, "contagem", None)
+    if mantidas is None:
+        mantidas = _travas_mantidas.contagem = defaultdict(int)
+    chave = os.path.abspath(path)
+    if mantidas[chave]:
+        # Já travado por esta thread (ex.: compactação dentro de um anexo ao diário)
+        mantidas[chave] += 1
+        try: yield
+        finally: mantidas[chave] -= 1
+        return
+
+    if fcntl is None:
+        trava = _travas_locais[chave]
+        trava.acquire()
+    else:
+        trava = open(f"{chave}.lock", "a")
+        fcntl.flock(trava.fileno(), fcntl.LOCK_EX)
+    mantidas[chave] = 1
+    try:
+        yield
+    finally:
+        mantidas[chave] = 0
+        if fcntl is None:
+            trava.release()
+        else:
+            fcntl.flock(trava.fileno(), fcntl.LOCK_UN)
+            trava.close()
+
 # PERSISTÊNCIA JSON
-def salvar_dados_locais(dados):
-    path = get_user_data_path()
-    if path:
-        with open(path, "w") as f: json.dump(dados, f)
+# Cada usuário tem um snapshot (dados_<user>.json) e um diário append-only
+# (dados_<user>.jsonl). Novos registros viram uma linha "add", regravações uma
+# linha "upd" e exclusões uma linha "del" (tombstone); a compactação reescreve
+# o snapshot e zera o diário.
+LIMITE_COMPACTACAO_BYTES = 256 * 1024
+LOTE_GRAVACAO_DIRETA = 1000
+
+def get_journal_path(path):
+    return f"{path}l" if path else None
+
+def novo_id_registro():
+    return uuid.uuid4().hex
+
+def _garantir_ids(registros):
+    """Atribui ID estável aos registros legados. Retorna True se algum foi alterado."""
+    alterado = False
+    for reg in registros:
+        if not reg.get('id'):
+            reg['id'] = novo_id_registro()
+            alterado = True
+    return alterado
+
+def _aplicar_diario(registros, journal_path):
+    """Reaplica o diário sobre o snapshot. Operações repetidas são idempotentes."""
+    por_id = {reg['id']: reg for reg in registros}
+    with open(journal_path, "r") as f:
+        for linha in f:
+            linha = linha.strip()
+            if not linha: continue
+            try:
+                entrada = json.loads(linha)
+            except json.JSONDecodeError:
+                # Última linha incompleta (queda durante a escrita): ignora
+                continue
+            if entrada.get('op') == 'add':
+                reg = entrada['registro']
+                por_id[reg['id']] = reg
+            elif entrada.get('op') == 'upd':
+                reg = entrada['registro']
+                if reg['id'] in por_id: por_id[reg['id']] = reg
+            elif entrada.get('op') == 'del':
+                por_id.pop(entrada.get('id'), None)
+    return list(por_id.values())
+
+def _anexar_diario(path, entradas):
+    """Anexa as operações ao diário (chamar sob bloqueio_arquivo(path))."""
+    assinatura_antes = _assinatura_base(path)
+    with open(get_journal_path(path), "a+b") as f:
+        # Linha incompleta de uma queda: fecha com "\n" para não fundir com a próxima
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n": f.write(b"\n")
+        f.write("".join(json.dumps(e) + "\n" for e in entradas).encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+    _atualizar_metadados(path, assinatura_antes, entradas)
+
+def _compactar_se_necessario(path):
+    """Reescreve o snapshot quando o diário cresce mais que o próprio snapshot."""
+    journal = get_journal_path(path)
+    tam_diario = os.path.getsize(journal) if os.path.exists(journal) else 0
+    tam_snapshot = os.path.getsize(path) if os.path.exists(path) else 0
+    if tam_diario > max(LIMITE_COMPACTACAO_BYTES, tam_snapshot):
+        _salvar_json(_carregar_json(path), path)
+
+def _salvar_json(dados, path):
+    """Grava o snapshot completo e descarta o diário (compactação)."""
+    _garantir_ids(dados)
+    with bloqueio_arquivo(path):
+        gravar_json_atomico(path, dados)
+        journal = get_journal_path(path)
+        if os.path.exists(journal): os.remove(journal)
+    _gravar_metadados(path, dados)
+
+def _carregar_json(path):
+    # Sob a trava: snapshot e diário lidos no mesmo estado (sem compactação no meio)
+    with bloqueio_arquivo(path):
+        registros = []
+        if os.path.exists(path):
+            with open(path, "r") as f: registros = json.load(f)
+        journal = get_journal_path(path)
+        tem_diario = os.path.exists(journal)
+        if not registros and not tem_diario: return []
+        
+        # Arquivos legados (.json sem IDs) recebem IDs fixados no snapshot
+        faltavam_ids = _garantir_ids(registros)
+        if tem_diario:
+            registros = _aplicar_diario(registros, journal)
+        if faltavam_ids:
+            _salvar_json(registros, path)
+        return registros
+
+# API DE REGISTROS (JSON com diário ou SQLite, conforme POUP_BACKEND)
+@perf.medir("salvar_dados_locais")
+def salvar_dados_locais(dados, path_especifico=None):
+    path = path_especifico if path_especifico else get_user_data_path()
+    if not path: return
+    if usar_sqlite():
+        _garantir_ids(dados)
+        database.substituir(path, dados)
+    else:
+        _salvar_json(dados, path)
+
+@perf.medir("adicionar_registros_locais")
+def adicionar_registros_locais(novos, path_especifico=None):
+    """Anexa registros. Um ID já existente é substituído no lugar."""
+    path = path_especifico if path_especifico else get_user_data_path()
+    if not path or not novos: return
+    _garantir_ids(novos)
+    if usar_sqlite():
+        database.gravar(path, novos)
+    else:
+        with bloqueio_arquivo(path):
+            if len(novos) >= LOTE_GRAVACAO_DIRETA:
+                # Lote grande (importação): vai direto para o snapshot, numa gravação só
+                por_id = {reg['id']: reg for reg in _carregar_json(path)}
+                por_id.update((reg['id'], reg) for reg in novos)
+                _salvar_json(list(por_id.values()), path)
+            else:
+                _anexar_diario(path, [{"op": "add", "registro": reg} for reg in novos])
+                _compactar_se_necessario(path)
 
+def atualizar_registros_locais(registros, path_especifico=None):
+    """Regrava registros existentes; IDs já excluídos não são recriados."""
+    path = path_especifico if path_especifico else get_user_data_path()
+    if not path or not registros: return
+    if usar_sqlite():
+        database.atualizar(path, registros)
+    else:
+        with bloqueio_arquivo(path):
+            _anexar_diario(path, [{"op": "upd", "registro": reg} for reg in registros])
+            _compactar_se_necessario(path)
+
+def remover_registros_locais(ids, path_especifico=None):
+    """Remove registros pelo ID (no JSON, registra tombstones no diário)."""
+    path = path_especifico if path_especifico else get_user_data_path()
+    if not path or not ids: return
+    if usar_sqlite():
+        database.remover(path, ids)
+    else:
+        with bloqueio_arquivo(path):
+            _anexar_diario(path, [{"op": "del", "id": i} for i in ids])
+            _compactar_se_necessario(path)
+
+@perf.medir("carregar_dados_locais")
 def carregar_dados_locais(path_especifico=None):
     path = path_especifico if path_especifico else get_user_data_path()
-    if path and os.path.exists(path):
-        with open(path, "r") as f: return json.load(f)
-    return []
+    if not path: return []
+    if usar_sqlite(): return database.carregar(path)
+    return _carregar_json(path)
+
+def excluir_arquivo_dados(path):
+    """Remove a base de um técnico (snapshot, diário, metadados e linhas no SQLite)."""
+    with bloqueio_arquivo(path):
+        for arq in (path, get_journal_path(path)):
+            if os.path.exists(arq): os.remove(arq)
+    with bloqueio_arquivo(INDICE_ARQUIVOS):
+        indice = _ler_indice_arquivos()
+        if indice.pop(path, None) is not None:
+            _salvar_indice_arquivos(indice)
+    with _trava_metadados:
+        _metadados_memoria.pop(path, None)
+    if usar_sqlite():
+        database.excluir_origem(path)
+
+def _bases_json():
+    """Bases JSON existentes: snapshot ou só o diário (antes da primeira compactação)."""
+    bases = set()
+    for f in os.listdir("."):
+        if f.startswith("dados_") and f.endswith(".jsonl"): bases.add(f[:-1])
+        elif f.startswith("dados_") and f.endswith(".json"): bases.add(f)
+    return bases
+
+def listar_arquivos_dados():
+    arquivos = _bases_json()
+    if usar_sqlite():
+        arquivos.update(database.listar_origens())
+    return sorted(arquivos)
+
+# CONSULTAS (índices no SQLite; lista em memória no JSON)
+def registros_para_exportacao(registros=None, path_especifico=None):
+    """Registros na ordem de exportação (agrupados por aba no SQLite)."""
+    if usar_sqlite():
+        return database.registros_por_tipo(path_especifico or get_user_data_path())
+    return registros if registros is not None else carregar_dados_locais(path_especifico)
+
+def registros_do_pacote(registros, path_especifico=None):
+    """Registros na ordem de exportação, limitados aos informados (modo "somente novos")."""
+    ordenados = registros_para_exportacao(registros, path_especifico)
+    if ordenados is registros: return registros
+    ids = {r['id'] for r in registros}
+    return [r for r in ordenados if r['id'] in ids]
+
+# METADADOS E PRÉVIA DAS BASES (aba de auditoria)
+# Índice pequeno com contagem, tamanho, data e UCs de cada base, validado pela
+# assinatura (tamanho + mtime) do snapshot e do diário: uma base que não mudou
+# não é relida. As anexações ao diário só atualizam contadores em memória
+# (ID -> UC e registros por UC), em O(operações) e sem gravar o índice; sem
+# esse estado (após um reinício ou escrita de outro processo) a próxima
+# consulta relê a base uma vez. A prévia lê só o começo do snapshot, aplicando o diário.
+INDICE_ARQUIVOS = "indice_arquivos.json"
+
+# path -> {"assinatura", "ucs_por_id": {id: UC}, "por_uc": Counter}
+_metadados_memoria = {}
+_trava_metadados = threading.Lock()
+
+def _assinatura_base(path):
+    assinatura = []
+    for arq in (path, get_journal_path(path)):
+        try:
+            info = os.stat(arq)
+            assinatura.append([info.st_size, info.st_mtime_ns])
+        except FileNotFoundError:
+            assinatura.append(None)
+    return assinatura
+
+def _ler_indice_arquivos():
+    try:
+        with open(INDICE_ARQUIVOS, "r") as f: return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _salvar_indice_arquivos(indice):
+    gravar_json_atomico(INDICE_ARQUIVOS, indice)
+
+def _meta_do_estado(estado):
+    existentes = [a for a in estado["assinatura"] if a]
+    return {
+        "assinatura": estado["assinatura"],
+        "registros": len(estado["ucs_por_id"]),
+        "ucs": len(estado["por_uc"]),
+        "tamanho": sum(a[0] for a in existentes),
+        "modificado": max((a[1] for a in existentes), default=0) / 1e9,
+    }
+
+def _gravar_metadados(path, registros):
+    """Calcula e grava no índice os metadados da base a partir dos registros."""
+    ucs_por_id = {r['id']: uc_do_registro(r) for r in registros}
+    estado = {"assinatura": _assinatura_base(path), "ucs_por_id": ucs_por_id, "por_uc": Counter(ucs_por_id.values())}
+    meta = _meta_do_estado(estado)
+    with bloqueio_arquivo(INDICE_ARQUIVOS):
+        indice = _ler_indice_arquivos()
+        indice[path] = meta
+        _salvar_indice_arquivos(indice)
+    with _trava_metadados:
+        _metadados_memoria[path] = estado
+    return meta
+
+def _atualizar_metadados(path, assinatura_antes, entradas):
+    """Aplica aos contadores em memória as operações recém-anexadas ao diário."""
+    with _trava_metadados:
+        estado = _metadados_memoria.get(path)
+        if not estado or estado["assinatura"] != assinatura_antes:
+            _metadados_memoria.pop(path, None)
+            return
+        ucs_por_id, por_uc = estado["ucs_por_id"], estado["por_uc"]
+        for entrada in entradas:
+            if entrada["op"] == "del":
+                antiga = ucs_por_id.pop(entrada["id"], None)
+            elif entrada["op"] == "add" or entrada["registro"]["id"] in ucs_por_id:
+                nova = uc_do_registro(entrada["registro"])
+                antiga = ucs_por_id.get(entrada["registro"]["id"])
+                ucs_por_id[entrada["registro"]["id"]] = nova
+                por_uc[nova] += 1
+            else:
+                continue
+            if antiga is not None:
+                por_uc[antiga] -= 1
+                if not por_uc[antiga]: del por_uc[antiga]
+        estado["assinatura"] = _assinatura_base(path)
+
+def metadados_arquivo(path):
+    """{"registros", "ucs", "tamanho" (bytes), "modificado" (epoch)} da base."""
+    if usar_sqlite():
+        return database.metadados(path)
+    assinatura = _assinatura_base(path)
+    with _trava_metadados:
+        estado = _metadados_memoria.get(path)
+        if estado and estado["assinatura"] == assinatura:
+            return _meta_do_estado(estado)
+    with bloqueio_arquivo(INDICE_ARQUIVOS):
+        meta = _ler_indice_arquivos().get(path)
+    if meta and meta["assinatura"] == assinatura:
+        return meta
+    return _gravar_metadados(path, _carregar_json(path))
+
+def _iterar_json_array(path, bloco=64 * 1024):
+    """Percorre os objetos de um array JSON em disco sem carregar o arquivo inteiro."""
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buffer, pos, fim_arquivo = "", 0, False
+        while True:
+            # Pula espaços, o "[" inicial e as vírgulas entre os objetos
+            while pos < len(buffer) and buffer[pos] in " \t\r\n[,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos >= len(buffer): raise ValueError
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if fim_arquivo: return
+                lido = f.read(bloco)
+                fim_arquivo = not lido
+                buffer, pos = buffer[pos:] + lido, 0
+                continue
+            yield obj
+
+def _estado_final_diario(journal_path):
+    """
+    Resultado do diário por ID: (existe, registro, ordem). 'ordem' é a posição da
+    reinserção quando o registro foi (re)criado pelo diário, indo para o fim da lista.
+    """
+    estados = {}
+    if not os.path.exists(journal_path): return estados
+    with open(journal_path, "r") as f:
+        for n, linha in enumerate(f):
+            try:
+                entrada = json.loads(linha)
+            except json.JSONDecodeError:
+                continue
+            op = entrada.get('op')
+            rid = entrada['registro']['id'] if op in ('add', 'upd') else entrada.get('id')
+            estados.setdefault(rid, []).append((n, op, entrada.get('registro')))
+    return estados
+
+def _aplicar_ops(ops, existe, reg):
+    ordem = None
+    for n, op, novo in ops:
+        if op == 'add':
+            if not existe: ordem = n
+            existe, reg = True, novo
+        elif op == 'upd' and existe:
+            reg = novo
+        elif op == 'del' and existe:
+            existe, ordem = False, None
+    return existe, reg, ordem
+
+def _linha_previa(reg):
+    return {"UC": reg.get('cod_instalacao'), "Tipo": reg.get('tipo_equipamento'), "Data": reg.get('data_hora')}
+
+def previa_registros(path, limite=None):
+    """Primeiros 'limite' registros da base (UC, tipo, data), sem carregá-la inteira."""
+    if usar_sqlite():
+        return database.previa(path, limite)
+    ops_por_id = _estado_final_diario(get_journal_path(path))
+    previa, vistos, reinseridos = [], set(), []
+    if os.path.exists(path):
+        for reg in _iterar_json_array(path):
+            if limite and len(previa) >= limite: return previa
+            rid = reg.get('id')
+            vistos.add(rid)
+            existe, reg, ordem = _aplicar_ops(ops_por_id.get(rid, ()), True, reg)
+            if ordem is not None: reinseridos.append((ordem, reg))
+            elif existe: previa.append(_linha_previa(reg))
+    # Registros criados (ou recriados) pelo diário entram no fim, na ordem de inserção
+    for rid, ops in ops_por_id.items():
+        if rid in vistos: continue
+        existe, reg, ordem = _aplicar_ops(ops, False, None)
+        if existe: reinseridos.append((ordem, reg))
+    previa.extend(_linha_previa(reg) for _, reg in sorted(reinseridos, key=lambda x: x[0]))
+    return previa[:limite] if limite else previa
+
+def migrar_json_para_sqlite(arquivos=None):
+    """Migração única dos dados_*.json (snapshot + diário) para o SQLite."""
+    if arquivos is None:
+        arquivos = sorted(_bases_json())
+    resultado = {}
+    for arq in arquivos:
+        registros = _carregar_json(arq)
+        database.gravar(arq, registros)
+        resultado[arq] = len(registros)
+    return resultado
+
+# ÍNDICE DE UCs DA SESSÃO
+def uc_do_registro(reg):
+    return reg.get('cod_instalacao') or reg.get('dados', {}).get('Nome da Unidade Consumidora', 'UC Indefinida')
+
+class IndiceUC:
+    """
+    Registros da sessão indexados pelo ID estável, com o agrupamento por UC e
+    os agregados de cada grupo (itens, fotos, data do primeiro item) mantidos
+    de forma incremental: incluir e excluir custam O(1), sem reconstrução.
+    """
+    def __init__(self, registros=()):
+        self.registros = {}   # id -> registro (ordem de inclusão)
+        self.grupos = {}      # uc -> {id: None} (ordem de inclusão)
+        self.agregados = {}   # uc -> {"uc", "qtd_itens", "qtd_fotos", "data_primeira"}
+        self.versao = 0       # muda a cada inclusão/exclusão (chave de caches derivados)
+        self.token = uuid.uuid4().hex  # distingue índices (outro login, "Excluir Tudo")
+        for reg in registros:
+            self.adicionar(reg)
+
+    def __len__(self):
+        return len(self.registros)
+
+    def adicionar(self, reg):
+        rid = reg['id']
+        if rid in self.registros:
+            self.remover([rid])
+        uc = uc_do_registro(reg)
+        self.registros[rid] = reg
+        self.versao += 1
+        if uc not in self.grupos:
+            self.grupos[uc] = {}
+            self.agregados[uc] = {"uc": uc, "qtd_itens": 0, "qtd_fotos": 0, "data_primeira": reg.get('data_hora', '-')}
+        self.grupos[uc][rid] = None
+        ag = self.agregados[uc]
+        ag["qtd_itens"] += 1
+        ag["qtd_fotos"] += len(reg.get('fotos', []))
+
+    def remover(self, ids):
+        for rid in ids:
+            reg = self.registros.pop(rid, None)
+            if reg is None: continue
+            self.versao += 1
+            uc = uc_do_registro(reg)
+            grupo = self.grupos[uc]
+            era_primeiro = next(iter(grupo)) == rid
+            del grupo[rid]
+            if not grupo:
+                del self.grupos[uc]
+                del self.agregados[uc]
+                continue
+            ag = self.agregados[uc]
+            ag["qtd_itens"] -= 1
+            ag["qtd_fotos"] -= len(reg.get('fotos', []))
+            if era_primeiro:
+                ag["data_primeira"] = self.registros[next(iter(grupo))].get('data_hora', '-')
+
+    def resumo(self):
+        """Grupos na ordem em que cada UC apareceu."""
+        return list(self.agregados.values())
+
+    def registros_da_uc(self, uc):
+        return [self.registros[rid] for rid in self.grupos.get(uc, ())]
+
+    def listar(self):
+        return list(self.registros.values())
 
 # LÓGICA DE FOTOS
 
@@ -114,13 +650,19 @@ def salvar_fotos_local(lista_fotos_obj, cod_instalacao):
     """
     Recebe uma lista de dicionários: [{'arquivo': buffer, 'nome': 'descricao'}]
     Salva no disco e retorna os metadados.
+    As fotos vão para o armazenamento por conteúdo (PASTA_BLOBS); a UC e a
+    descrição ficam só nos metadados e no nome de exportação.
     """
-    caminhos_salvos = []
-    
-    # Garantir pasta
-    if not os.path.exists(PASTA_FOTOS):
-        os.makedirs(PASTA_FOTOS)
-    
+    metadados, trabalhos = preparar_fotos(lista_fotos_obj)
+    concluir_fotos(trabalhos)
+    return metadados
+
+def preparar_fotos(lista_fotos_obj):
+    """
+    Lê as fotos anexadas e monta os metadados com status 'pendente', sem tocar
+    no disco. Retorna (metadados, trabalhos) para concluir_fotos.
+    """
+    metadados, trabalhos = [], []
     for item in lista_fotos_obj:
         arquivo = item['arquivo']
         nome_personalizado = item['nome']
@@ -131,162 +673,849 @@ def salvar_fotos_local(lista_fotos_obj, cod_instalacao):
             ext = os.path.splitext(nome_orig)[1]
             if not ext: ext = ".jpg"
             
+            conteudo = bytes(arquivo.getbuffer())
+            hash_foto = hashlib.sha256(conteudo).hexdigest()
+            
             # Limpar nome definido pelo usuário para ser seguro no Windows/Linux
             nome_limpo = "".join(x for x in nome_personalizado if x.isalnum() or x in " -_")
             if not nome_limpo: nome_limpo = "imagem_sem_nome"
             
-            # Timestamp para evitar sobrescrever
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S_%f")
-            
-            # Nome final físico: UC_TIMESTAMP_DESCRIÇÃO.ext
-            nome_arquivo_final = f"{cod_instalacao}_{timestamp}_{nome_limpo}{ext}"
-            caminho_completo = os.path.join(PASTA_FOTOS, nome_arquivo_final)
-            
-            # Salvar bytes
-            with open(caminho_completo, "wb") as f:
-                f.write(arquivo.getbuffer())
-            
-            caminhos_salvos.append({
-                "caminho_fisico": caminho_completo,
+            meta = {
+                "caminho_fisico": os.path.join(PASTA_BLOBS, hash_foto[:2], f"{hash_foto}{ext.lower()}"),
+                "hash": hash_foto,
+                "caminho_miniatura": None,
                 "nome_exportacao": f"{nome_limpo}{ext}", # Nome bonito para o ZIP
-                "nome_original": nome_orig
-            })
-            
-    return caminhos_salvos
+                "nome_original": nome_orig,
+                "bytes_original": len(conteudo),
+                "bytes_armazenado": None,
+                "status": "pendente"
+            }
+            metadados.append(meta)
+            trabalhos.append((meta, conteudo, ext))
+    return metadados, trabalhos
+
+def concluir_fotos(trabalhos):
+    """Grava os blobs e completa os metadados (status 'concluido' ou 'erro')."""
+    for meta, conteudo, ext in trabalhos:
+        try:
+            caminho, bytes_armazenado, _ = gravar_blob(conteudo, ext, meta["hash"])
+        except OSError:
+            meta["status"] = "erro"
+            continue
+        # A recompressão pode ter trocado a extensão (ex.: PNG -> JPEG)
+        nome_base = os.path.splitext(meta["nome_exportacao"])[0]
+        meta.update({
+            "caminho_fisico": caminho,
+            "caminho_miniatura": obter_miniatura({"caminho_fisico": caminho}),
+            "nome_exportacao": f"{nome_base}{os.path.splitext(caminho)[1]}",
+            "bytes_armazenado": bytes_armazenado,
+            "status": "concluido"
+        })
+
+# ARMAZENAMENTO POR CONTEÚDO
+# Cada foto é gravada uma única vez em PASTA_BLOBS/<2 primeiros>/<sha256><ext>,
+# com o hash calculado sobre os bytes recebidos (antes da recompressão), para
+# que um reenvio nem precise ser reprocessado. Os registros apontam para o blob
+# em 'caminho_fisico'; caminhos antigos continuam válidos por serem arquivos comuns.
+PASTA_BLOBS = os.path.join(PASTA_FOTOS, "blobs")
+
+def _localizar_blob(hash_foto):
+    pasta = os.path.join(PASTA_BLOBS, hash_foto[:2])
+    if os.path.isdir(pasta):
+        for nome in os.listdir(pasta):
+            if os.path.splitext(nome)[0] == hash_foto:
+                return os.path.join(pasta, nome)
+    return None
+
+def gravar_blob(conteudo, ext, hash_foto=None):
+    """Grava (ou reaproveita) a foto. Retorna (caminho, bytes armazenados, hash)."""
+    hash_foto = hash_foto or hashlib.sha256(conteudo).hexdigest()
+    existente = _localizar_blob(hash_foto)
+    if existente:
+        return existente, os.path.getsize(existente), hash_foto
+    
+    if FOTO_RECOMPRIMIR:
+        reduzido = recomprimir_foto(conteudo)
+        if reduzido is not None:
+            conteudo, ext = reduzido, ".jpg"
+    
+    pasta = os.path.join(PASTA_BLOBS, hash_foto[:2])
+    os.makedirs(pasta, exist_ok=True)
+    caminho = os.path.join(pasta, f"{hash_foto}{ext.lower()}")
+    
+    # Outra sessão nunca enxerga um blob pela metade
+    with escrita_atomica(caminho, "wb") as f:
+        f.write(conteudo)
+    return caminho, len(conteudo), hash_foto
+
+# GRAVAÇÃO DE FOTOS EM SEGUNDO PLANO
+# O registro é salvo na hora com as fotos 'pendente'; um pool limitado grava os
+# blobs e regrava o registro (mesmo ID) ao terminar. Se a fila estiver cheia,
+# quem agenda espera uma vaga.
+TRABALHADORES_FOTOS = 2
+FILA_FOTOS_MAX = 16
+
+_pool_fotos = ThreadPoolExecutor(max_workers=TRABALHADORES_FOTOS, thread_name_prefix="gravacao_fotos")
+_vagas_fotos = threading.BoundedSemaphore(FILA_FOTOS_MAX)
+_gravacoes = {}  # id do registro -> (arquivo de dados, Future)
+
+def _gravar_fotos_registro(registro, trabalhos, path):
+    try:
+        concluir_fotos(trabalhos)
+        atualizar_registros_locais([registro], path_especifico=path)
+    except Exception as e:
+        # O Future guardaria a exceção sem ninguém ler: registra e marca as fotos
+        print(f"gravação de fotos do registro {registro.get('id')} falhou: {type(e).__name__}: {e}")
+        for meta, _, _ in trabalhos:
+            if meta["status"] == "pendente": meta["status"] = "erro"
+        try:
+            atualizar_registros_locais([registro], path_especifico=path)
+        except Exception as e2:
+            print(f"registro {registro.get('id')} ficou sem o status das fotos: {type(e2).__name__}: {e2}")
+
+def agendar_gravacao_fotos(registro, trabalhos, path_especifico=None):
+    if not trabalhos: return
+    # Resolvido aqui: a thread de gravação não tem acesso ao session_state
+    path = path_especifico if path_especifico else get_user_data_path()
+    _vagas_fotos.acquire()
+    futuro = _pool_fotos.submit(_gravar_fotos_registro, registro, trabalhos, path)
+    _gravacoes[registro['id']] = (path, futuro)
+
+    def finalizar(_):
+        _gravacoes.pop(registro['id'], None)
+        _vagas_fotos.release()
+    futuro.add_done_callback(finalizar)
+
+def estado_fotos(registro):
+    """Retorna (em gravação, com falha) para as fotos de um registro."""
+    em_andamento = registro.get('id') in _gravacoes
+    pendentes = falhas = 0
+    for foto in registro.get('fotos', []):
+        status = foto.get('status', 'concluido')
+        if status == 'pendente':
+            # Pendente sem gravação ativa: o processo caiu antes de concluir
+            if em_andamento: pendentes += 1
+            elif not os.path.exists(foto['caminho_fisico']): falhas += 1
+        elif status == 'erro':
+            falhas += 1
+    return pendentes, falhas
+
+def aguardar_fotos_pendentes(path_especifico=None, timeout=60):
+    """Espera as gravações do arquivo de dados. Retorna quantas ainda não terminaram."""
+    path = path_especifico if path_especifico else get_user_data_path()
+    futuros = [f for p, f in list(_gravacoes.values()) if p == path]
+    _, nao_concluidos = wait(futuros, timeout=timeout)
+    return len(nao_concluidos)
+
+def recomprimir_foto(conteudo):
+    """
+    Aplica a orientação EXIF, limita o maior lado a FOTO_LADO_MAX e regrava em
+    JPEG com FOTO_QUALIDADE_JPEG. Retorna None quando não vale a pena (imagem
+    ilegível, ou já pequena e sem rotação e a regravação não a reduziria).
+    """
+    try:
+        with Image.open(io.BytesIO(conteudo)) as img:
+            girar = img.getexif().get(0x0112, 1) != 1
+            reduzir = max(img.size) > FOTO_LADO_MAX
+            img = ImageOps.exif_transpose(img)
+            if reduzir:
+                img.thumbnail((FOTO_LADO_MAX, FOTO_LADO_MAX), Image.LANCZOS)
+            if img.mode in ("RGBA", "LA", "P"):
+                # JPEG não tem transparência: achata sobre fundo branco
+                img = img.convert("RGBA")
+                fundo = Image.new("RGB", img.size, (255, 255, 255))
+                fundo.paste(img, mask=img.getchannel("A"))
+                img = fundo
+            saida = io.BytesIO()
+            img.convert("RGB").save(saida, "JPEG", quality=FOTO_QUALIDADE_JPEG, optimize=True)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    if not (girar or reduzir) and saida.tell() >= len(conteudo):
+        return None
+    return saida.getvalue()
+
+# MINIATURAS
+# Previews pequenos gravados ao lado do original (<nome>_mini.jpg); listagem e
+# galeria usam a miniatura e o original só é carregado quando pedido.
+TAMANHO_MINIATURA = 320
+QUALIDADE_MINIATURA = 70
+
+def _caminho_miniatura(caminho_fisico):
+    return f"{os.path.splitext(caminho_fisico)[0]}_mini.jpg"
+
+def _reduzir_imagem(origem, destino):
+    with Image.open(origem) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((TAMANHO_MINIATURA, TAMANHO_MINIATURA))
+        img.convert("RGB").save(destino, "JPEG", quality=QUALIDADE_MINIATURA)
+
+def gerar_miniatura(caminho_fisico):
+    """Gera a miniatura de uma foto salva. Retorna o caminho ou None se falhar."""
+    caminho = _caminho_miniatura(caminho_fisico)
+    try:
+        _reduzir_imagem(caminho_fisico, caminho)
+        return caminho
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+def gerar_miniatura_bytes(arquivo):
+    """Miniatura em memória para arquivos ainda não salvos (galeria temporária)."""
+    try:
+        arquivo.seek(0)
+        saida = io.BytesIO()
+        _reduzir_imagem(arquivo, saida)
+        return saida.getvalue()
+    except (OSError, Image.DecompressionBombError):
+        return None
+    finally:
+        arquivo.seek(0)
+
+def obter_miniatura(foto):
+    """Caminho da miniatura; registros legados têm a sua gerada na primeira exibição."""
+    caminho = foto.get("caminho_miniatura") or _caminho_miniatura(foto["caminho_fisico"])
+    if os.path.exists(caminho):
+        return caminho
+    if os.path.exists(foto["caminho_fisico"]):
+        return gerar_miniatura(foto["caminho_fisico"])
+    return None
 
 # LÓGICA EXCEL E ZIP
+NS_PLANILHA = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_REL_DOC = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_REL_PKG = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def _caminhos_abas(z):
+    """(nome da aba, caminho do XML no pacote) na ordem do workbook."""
+    rels = ElementTree.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+    alvos = {r.get("Id"): r.get("Target") for r in rels.iter(f"{NS_REL_PKG}Relationship")}
+    workbook = ElementTree.fromstring(z.read("xl/workbook.xml"))
+    for sheet in workbook.iter(f"{NS_PLANILHA}sheet"):
+        alvo = alvos[sheet.get(f"{NS_REL_DOC}id")]
+        yield sheet.get("name"), alvo.lstrip("/") if alvo.startswith("/") else f"xl/{alvo}"
+
+def _ler_validacoes(buffer):
+    """
+    Lê as validações de dados direto do XML de cada aba, já que o modo
+    read-only do openpyxl não as carrega. Retorna {aba: [(tipo, sqref, formula1)]}.
+    """
+    with zipfile.ZipFile(buffer) as z:
+        validacoes = {}
+        for nome, caminho in _caminhos_abas(z):
+            lista = []
+            with z.open(caminho) as xml:
+                for _, elem in ElementTree.iterparse(xml):
+                    if elem.tag == f"{NS_PLANILHA}dataValidation":
+                        formula = elem.find(f"{NS_PLANILHA}formula1")
+                        lista.append((elem.get("type"), elem.get("sqref", ""), formula.text if formula is not None else None))
+                    elif elem.tag == f"{NS_PLANILHA}row":
+                        elem.clear()
+            validacoes[nome] = lista
+        return validacoes
+
+def _validacoes_openpyxl(buffer):
+    """Caminho antigo (carga completa), usado se o XML não puder ser lido."""
+    wb = load_workbook(buffer, data_only=True)
+    return {
+        ws.title: [(dv.type, str(dv.sqref), dv.formula1) for dv in ws.data_validations.dataValidation]
+        for ws in wb.worksheets
+    }
+
+def montar_cabecalhos(celulas):
+    """Cabeçalhos a partir das células da linha 1: [(valor, letra da coluna)]."""
+    return [{"nome": str(valor), "col_letter": letra, "tipo": "texto", "opcoes": []} for valor, letra in celulas if valor]
+
+@perf.medir("analisar_modelo_excel")
 def analisar_modelo_excel(file_content):
     try:
         buffer = io.BytesIO(file_content) if isinstance(file_content, bytes) else io.BytesIO(file_content.getvalue())
-        wb = load_workbook(buffer, data_only=True)
+        try:
+            validacoes = _ler_validacoes(buffer)
+        except (KeyError, zipfile.BadZipFile, ElementTree.ParseError):
+            validacoes = _validacoes_openpyxl(buffer)
+        
+        # Só a linha 1 interessa: carga read-only
+        wb = load_workbook(buffer, read_only=True, data_only=True)
         estrutura = {}
         for sheet_name in wb.sheetnames:
             sheet = wb[sheet_name]
-            headers = []
-            for cell in sheet[1]:
-                if cell.value:
-                    headers.append({"nome": str(cell.value), "col_letter": cell.column_letter, "tipo": "texto", "opcoes": []})
+            primeira = next(sheet.iter_rows(min_row=1, max_row=1), ())
+            headers = montar_cabecalhos((cell.value, cell.column_letter) for cell in primeira if cell.value)
             
             # Melhoria na detecção de validação de dados
-            for dv in sheet.data_validations.dataValidation:
-                if dv.type == "list":
-                    for ref in str(dv.sqref).split():
+            for tipo_dv, sqref, formula in validacoes.get(sheet_name, []):
+                if tipo_dv == "list":
+                    for ref in sqref.split():
                         col_letter = "".join(filter(str.isalpha, ref.split(':')[0]))
                         for h in headers:
                             if h["col_letter"] == col_letter:
                                 h["tipo"] = "selecao"
-                                formula = dv.formula1
                                 # Ajuste: remove aspas e espaços extras para garantir que a lista seja lida
                                 if formula:
                                     opcoes_limpas = formula.replace('"', '').split(',')
                                     h["opcoes"] = [op.strip() for op in opcoes_limpas]
                                     
             estrutura[sheet_name] = [{"nome": h["nome"], "tipo": h["tipo"], "opcoes": h["opcoes"]} for h in headers]
+        wb.close()
         return estrutura
     except Exception as e:
         st.error(f"Erro ao analisar o Excel: {e}")
         return {}
 
+# CACHE DA ESTRUTURA DO MODELO
+# A estrutura analisada é guardada em disco pela SHA-256 dos bytes do modelo;
+# todos os usuários do Levantamento_Base.xlsx padrão compartilham a mesma entrada.
+# VERSAO_ANALISE entra na chave: incremente ao mudar o que analisar_modelo_excel
+# devolve, para que entradas antigas não sejam reaproveitadas.
+PASTA_CACHE = ".cache"
+VERSAO_ANALISE = 1
+_cache_estruturas = {}
+
+def obter_estrutura_modelo(content):
+    chave = f"v{VERSAO_ANALISE}_{hashlib.sha256(content).hexdigest()}"
+    if chave in _cache_estruturas:
+        return _cache_estruturas[chave]
+    
+    caminho = os.path.join(PASTA_CACHE, f"modelo_{chave}.json")
+    if os.path.exists(caminho):
+        with open(caminho, "r") as f: estrutura = json.load(f)
+    else:
+        estrutura = analisar_modelo_excel(content)
+        if not estrutura: return estrutura  # erro de leitura não vai para o cache
+        os.makedirs(PASTA_CACHE, exist_ok=True)
+        gravar_json_atomico(caminho, estrutura)
+    
+    _cache_estruturas[chave] = estrutura
+    return estrutura
+
 def carregar_modelo_atual():
     path_pessoal = get_user_template_path()
     if path_pessoal and os.path.exists(path_pessoal):
         with open(path_pessoal, "rb") as f:
             content = f.read()
             st.session_state['planilha_modelo'] = io.BytesIO(content)
-            st.session_state['estrutura_modelo'] = analisar_modelo_excel(content)
+            st.session_state['estrutura_modelo'] = obter_estrutura_modelo(content)
             st.session_state['origem_modelo'] = "Pessoal"
     elif os.path.exists(PLANILHA_PADRAO_ADMIN):
         with open(PLANILHA_PADRAO_ADMIN, "rb") as f:
             content = f.read()
             st.session_state['planilha_modelo'] = io.BytesIO(content)
-            st.session_state['estrutura_modelo'] = analisar_modelo_excel(content)
+            st.session_state['estrutura_modelo'] = obter_estrutura_modelo(content)
             st.session_state['origem_modelo'] = "Padrão do Sistema"
 
-def gerar_zip_exportacao(dados_lista):
+# IMPORTAÇÃO DE PLANILHAS PREENCHIDAS
+# Planilhas no formato do modelo, já preenchidas, viram registros: a aba é o
+# tipo de equipamento e as colunas são mapeadas pelo cabeçalho da linha 1
+# (mesma lógica de analisar_modelo_excel). As abas são lidas em streaming
+# direto do XML (como as validações); o openpyxl read-only fica de reserva.
+def _valor_importado(valor):
+    if isinstance(valor, datetime):
+        return valor.strftime("%d/%m/%Y")
+    if isinstance(valor, str):
+        return valor.strip() or None
+    return valor
+
+def _estilos_de_data(z):
+    """Índices de estilo (atributo s das células) cujo formato numérico é data."""
+    try:
+        estilos = ElementTree.fromstring(z.read("xl/styles.xml"))
+    except KeyError:
+        return set()
+    formatos = dict(BUILTIN_FORMATS)
+    for fmt in estilos.iter(f"{NS_PLANILHA}numFmt"):
+        formatos[int(fmt.get("numFmtId"))] = fmt.get("formatCode")
+    xfs = estilos.find(f"{NS_PLANILHA}cellXfs")
+    if xfs is None: return set()
+    return {str(i) for i, xf in enumerate(xfs.iter(f"{NS_PLANILHA}xf"))
+            if is_date_format(formatos.get(int(xf.get("numFmtId", 0)), "General"))}
+
+def _textos_compartilhados(z):
+    if "xl/sharedStrings.xml" not in z.namelist(): return []
+    textos = []
+    with z.open("xl/sharedStrings.xml") as xml:
+        for _, elem in ElementTree.iterparse(xml):
+            if elem.tag == f"{NS_PLANILHA}si":
+                textos.append("".join(t.text or "" for t in elem.iter(f"{NS_PLANILHA}t")))
+                elem.clear()
+    return textos
+
+def _linhas_aba_xml(xml, textos, estilos_data):
+    """Gera (número da linha, {índice da coluna (0-based): valor}) de uma aba."""
+    tag_c, tag_row, tag_v, tag_t = f"{NS_PLANILHA}c", f"{NS_PLANILHA}row", f"{NS_PLANILHA}v", f"{NS_PLANILHA}t"
+    linha, col = {}, -1
+    for _, elem in ElementTree.iterparse(xml):
+        tag = elem.tag
+        if tag == tag_c:
+            ref = elem.get("r")
+            col = column_index_from_string(ref.rstrip("0123456789")) - 1 if ref else col + 1
+            tipo = elem.get("t")
+            if tipo == "inlineStr":
+                valor = "".join(t.text or "" for t in elem.iter(tag_t))
+            else:
+                v = elem.find(tag_v)
+                texto = v.text if v is not None else None
+                if texto is None or tipo == "e":
+                    valor = None
+                elif tipo == "s":
+                    valor = textos[int(texto)]
+                elif tipo in ("str", "inlineStr"):
+                    valor = texto
+                elif tipo == "b":
+                    valor = texto == "1"
+                elif elem.get("s") in estilos_data:
+                    valor = from_excel(float(texto))
+                else:
+                    numero = float(texto)
+                    valor = int(numero) if numero.is_integer() and "." not in texto and "E" not in texto.upper() else numero
+            if valor is not None: linha[col] = valor
+            elem.clear()
+        elif tag == tag_row:
+            yield int(elem.get("r", 0)), linha
+            linha, col = {}, -1
+            elem.clear()
+
+def _abas_xml(buffer):
+    """Gera (nome da aba, linhas) lendo o pacote .xlsx diretamente."""
+    with zipfile.ZipFile(buffer) as z:
+        textos = _textos_compartilhados(z)
+        estilos_data = _estilos_de_data(z)
+        for nome, caminho in _caminhos_abas(z):
+            with z.open(caminho) as xml:
+                yield nome, _linhas_aba_xml(xml, textos, estilos_data)
+
+def _abas_openpyxl(buffer):
+    """Caminho de reserva: openpyxl read-only, bem mais lento em planilhas grandes."""
+    wb = load_workbook(buffer, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            yield ws.title, ((n, {i: v for i, v in enumerate(valores) if v is not None})
+                             for n, valores in enumerate(ws.iter_rows(values_only=True), start=1))
+    finally:
+        wb.close()
+
+def _registros_da_aba(aba, linhas, data_hora):
+    primeira = next(linhas, None)
+    if primeira is None or primeira[0] != 1: return []
+    headers = montar_cabecalhos((valor, get_column_letter(i + 1)) for i, valor in sorted(primeira[1].items()))
+    # Posição de cada campo na linha, calculada uma vez por aba
+    colunas = [(column_index_from_string(h["col_letter"]) - 1, h["nome"]) for h in headers]
+    if not colunas: return []
+    
+    registros = []
+    for _, valores in linhas:
+        dados = {}
+        for i, nome in colunas:
+            valor = _valor_importado(valores.get(i))
+            if valor is not None: dados[nome] = valor
+        if not dados: continue  # linha em branco
+        registros.append({
+            "id": novo_id_registro(),
+            "cod_instalacao": str(dados.get("Nome da Unidade Consumidora", "UC Indefinida")),
+            "tipo_equipamento": aba,
+            "data_hora": data_hora,
+            "dados": dados,
+            "fotos": []
+        })
+    return registros
+
+def _abas_do_modelo():
+    """Abas do modelo em uso na sessão; sem ele, as do modelo padrão."""
+    estrutura = st.session_state.get('estrutura_modelo')
+    if not estrutura and os.path.exists(PLANILHA_PADRAO_ADMIN):
+        with open(PLANILHA_PADRAO_ADMIN, "rb") as f: estrutura = obter_estrutura_modelo(f.read())
+    return set(estrutura or ())
+
+def importar_planilha_preenchida(file_content, abas_modelo=None):
+    """
+    Retorna (registros, {aba: quantidade}, abas ignoradas); nada é gravado aqui.
+    Só as abas do modelo viram registros (a aba "Resumo de Consumo" de uma
+    exportação, por exemplo, fica de fora).
+    """
+    buffer = io.BytesIO(file_content) if isinstance(file_content, bytes) else io.BytesIO(file_content.getvalue())
+    data_hora = get_data_hora_br().strftime("%d/%m/%Y %H:%M:%S")
+    abas_modelo = _abas_do_modelo() if abas_modelo is None else set(abas_modelo)
+    ignoradas = []
+
+    def ler(abas):
+        por_aba = {}
+        for aba, linhas in abas:
+            if aba in abas_modelo: por_aba[aba] = _registros_da_aba(aba, linhas, data_hora)
+            else: ignoradas.append(aba)
+        return por_aba
+
+    try:
+        por_aba = ler(_abas_xml(buffer))
+    except (KeyError, zipfile.BadZipFile, ElementTree.ParseError):
+        buffer.seek(0)
+        ignoradas.clear()
+        por_aba = ler(_abas_openpyxl(buffer))
+    registros = [reg for lista in por_aba.values() for reg in lista]
+    return registros, {aba: len(lista) for aba, lista in por_aba.items()}, ignoradas
+
+@perf.medir("gerar_zip_exportacao")
+def gerar_zip_exportacao(dados_lista, destino=None, resumo_consumo=False, modelo_bytes=None):
     """
     Gera um arquivo ZIP contendo o Excel de levantamento e uma pasta com as fotos.
+    Se 'destino' (arquivo aberto em modo binário) for informado, o ZIP é escrito
+    nele em vez de um BytesIO. 'resumo_consumo' acrescenta a aba de consumo estimado.
+    'modelo_bytes' substitui o modelo da sessão (uso fora do Streamlit).
     """
-    if 'planilha_modelo' not in st.session_state: return None
+    if modelo_bytes is not None:
+        modelo = io.BytesIO(modelo_bytes)
+    elif 'planilha_modelo' in st.session_state:
+        modelo = st.session_state['planilha_modelo']
+        modelo.seek(0)
+    else:
+        return None
     
-    # 1. Gerar o Excel em memória
-    st.session_state['planilha_modelo'].seek(0)
-    book = load_workbook(st.session_state['planilha_modelo'])
+    # 1. Preencher o modelo
+    book = load_workbook(modelo)
     
-    for registro in dados_lista:
-        if registro['tipo_equipamento'] in book.sheetnames:
-            sheet = book[registro['tipo_equipamento']]
-            
-            # Mapeamento dinâmico baseado no cabeçalho
-            headers = {sheet.cell(row=1, column=i).value: i for i in range(1, sheet.max_column + 1)}
-            
-            nova_linha_dados = registro['dados']
-            
-            # Preparar array para append (garantindo ordem)
-            # Como append adiciona no fim, precisamos garantir que as colunas batem com os valores
-            # Melhor abordagem com openpyxl para dados esparsos: escrever celula a celula na nova linha
-            next_row = sheet.max_row + 1
-            
-            for k, v in nova_linha_dados.items():
-                if k in headers:
-                    sheet.cell(row=next_row, column=headers[k], value=v)
-            
-            # Tratamento de Fotos no Excel (se houver coluna)
-            if "Fotos" in headers and "fotos" in registro:
-                 nomes_fotos = ", ".join([f['nome_exportacao'] for f in registro["fotos"]])
-                 sheet.cell(row=next_row, column=headers["Fotos"], value=nomes_fotos)
+    preencher_modelo(book, dados_lista)
+    if resumo_consumo:
+        analise.gravar_aba_resumo(book, dados_lista)
     
-    excel_buffer = io.BytesIO()
+    # 2. Criar o ZIP
+    zip_buffer = destino if destino is not None else io.BytesIO()
+    gravar_pacote_zip(book, dados_lista, zip_buffer)
+    zip_buffer.seek(0)
+    return zip_buffer
+
+def gravar_pacote_zip(book, dados_lista, zip_buffer):
+    """Grava a planilha já preenchida e as fotos dos registros no ZIP de destino."""
+    # Planilha vai para o disco se passar do limite do spool
+    excel_buffer = tempfile.SpooledTemporaryFile(max_size=LIMITE_SPOOL_BYTES)
     book.save(excel_buffer)
     excel_buffer.seek(0)
     
-    # 2. Criar o ZIP
-    zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
         # Adicionar Excel
-        zf.writestr("Levantamento_Cargas.xlsx", excel_buffer.getvalue())
+        with excel_buffer, zf.open("Levantamento_Cargas.xlsx", "w") as entrada:
+            shutil.copyfileobj(excel_buffer, entrada)
         
         # Adicionar Fotos
-        for registro in dados_lista:
-            if "fotos" in registro and registro["fotos"]:
-                uc = registro.get("cod_instalacao", "SemUC")
-                tipo = registro.get("tipo_equipamento", "Geral")
-                
-                # Pasta dentro do ZIP para organizar
-                folder_path = f"Fotos/{uc} - {tipo}/"
-                
-                for foto in registro["fotos"]:
-                    caminho_origem = foto["caminho_fisico"]
-                    if os.path.exists(caminho_origem):
-                        # Nome dentro do ZIP
-                        zf.write(caminho_origem, arcname=f"{folder_path}{foto['nome_exportacao']}")
+        empacotar_fotos(zf, dados_lista)
+
+# EMPACOTAMENTO DE FOTOS
+# As fotos são lidas do disco num pool de threads, com uma janela limitada de
+# leituras em andamento; a gravação no ZIP (com o CRC que o zipfile calcula)
+# fica na thread que monta o pacote. JPEG/PNG entram sem compressão, pois não
+# encolhem com deflate.
+EXTENSOES_JA_COMPRIMIDAS = {".jpg", ".jpeg", ".png"}
+TRABALHADORES_EMPACOTAMENTO = min(8, (os.cpu_count() or 1) + 4)
+
+def _entradas_fotos(dados_lista):
+    """
+    Nomes no ZIP agrupados por arquivo no disco, na ordem dos registros. O mesmo
+    arquivo no mesmo nome entra uma vez; arquivos diferentes que cairiam no mesmo
+    nome (ex.: "Foto 1.jpg" de dois registros da UC) ganham " (2)", " (3)"...
+    """
+    entradas = OrderedDict()
+    usados = {}  # nome no ZIP -> arquivo no disco
+    for registro in dados_lista:
+        if registro.get("fotos"):
+            uc = registro.get("cod_instalacao", "SemUC")
+            tipo = registro.get("tipo_equipamento", "Geral")
+            
+            # Pasta dentro do ZIP para organizar (na consolidação, uma por técnico)
+            folder_path = f"{registro.get('pasta_fotos', 'Fotos')}/{uc} - {tipo}/"
+            for foto in registro["fotos"]:
+                caminho = foto["caminho_fisico"]
+                arcname = f"{folder_path}{foto['nome_exportacao']}"
+                base, ext = os.path.splitext(arcname)
+                n = 2
+                while usados.get(arcname, caminho) != caminho:
+                    arcname = f"{base} ({n}){ext}"
+                    n += 1
+                if arcname in usados: continue
+                usados[arcname] = caminho
+                entradas.setdefault(caminho, []).append(arcname)
+    return entradas
+
+def _ler_foto(caminho):
+    try:
+        data_hora = time.localtime(os.path.getmtime(caminho))[:6]
+        with open(caminho, "rb") as f: conteudo = f.read()
+    except OSError:
+        return None
+    return data_hora, conteudo
+
+def empacotar_fotos(zf, dados_lista):
+    entradas = _entradas_fotos(dados_lista)
+    if not entradas: return
+
+    def gravar(caminho, futuro):
+        lido = futuro.result()
+        if lido is None: return
+        data_hora, conteudo = lido
+        # Um blob compartilhado por vários registros é lido uma vez e
+        # gravado sob o nome de exportação de cada um
+        for arcname in entradas[caminho]:
+            zinfo = zipfile.ZipInfo(arcname, date_time=data_hora)
+            ext = os.path.splitext(arcname)[1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in EXTENSOES_JA_COMPRIMIDAS else zipfile.ZIP_DEFLATED
+            zf.writestr(zinfo, conteudo)
     
-    zip_buffer.seek(0)
-    return zip_buffer
+    janela = TRABALHADORES_EMPACOTAMENTO * 2
+    with ThreadPoolExecutor(max_workers=TRABALHADORES_EMPACOTAMENTO) as pool:
+        pendentes = deque()
+        for caminho in entradas:
+            pendentes.append((caminho, pool.submit(_ler_foto, caminho)))
+            if len(pendentes) >= janela:
+                gravar(*pendentes.popleft())
+        while pendentes:
+            gravar(*pendentes.popleft())
+
+# CONSOLIDAÇÃO DA CAMPANHA (vários técnicos num pacote só)
+# Cada base é lida e convertida em linhas por aba num processo separado; o
+# processo principal só grava as linhas no modelo (uma vez) e empacota as fotos.
+def _preparar_base_tecnico(path, mapas):
+    inicio = time.perf_counter()
+    registros = carregar_dados_locais(path)
+    linhas = preparar_linhas_por_aba(registros, mapas)
+    # Para as fotos basta o necessário para montar os nomes no ZIP; a pasta do
+    # técnico evita que "Foto 1.jpg" de bases diferentes caiam no mesmo nome
+    pasta = f"Fotos/{tecnico_do_arquivo(path)}"
+    fotos = [{"cod_instalacao": r.get("cod_instalacao", "SemUC"), "tipo_equipamento": r.get("tipo_equipamento", "Geral"),
+              "fotos": r["fotos"], "pasta_fotos": pasta}
+             for r in registros if r.get("fotos")]
+    return dict(linhas), fotos, len(registros), time.perf_counter() - inicio
+
+def tecnico_do_arquivo(path):
+    nome = os.path.basename(path)
+    return nome[len("dados_"):-len(".json")] if nome.startswith("dados_") and nome.endswith(".json") else nome
+
+def consolidar_levantamentos(arquivos, modelo_bytes, destino):
+    """
+    Junta as bases dos técnicos selecionados numa planilha (modelo preenchido
+    uma única vez) e num ZIP com todas as fotos, gravado em 'destino'.
+    Retorna o relatório por técnico e os tempos de cada etapa.
+    """
+    inicio = time.perf_counter()
+    book = load_workbook(io.BytesIO(modelo_bytes))
+    mapas = {aba: mapa_cabecalhos(book[aba]) for aba in book.sheetnames}
+
+    # 'spawn': o servidor do Streamlit tem várias threads, e fork copiaria travas seguradas por elas
+    trabalhadores = max(1, min(len(arquivos), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=trabalhadores, mp_context=multiprocessing.get_context("spawn")) as pool:
+        resultados = list(pool.map(_preparar_base_tecnico, arquivos, [mapas] * len(arquivos)))
+    t_preparo = time.perf_counter() - inicio
+
+    relatorio = []
+    fotos_todas = []
+    for arq, (linhas, fotos, qtd, segundos) in zip(arquivos, resultados):
+        escrever_linhas(book, linhas)
+        fotos_todas.extend(fotos)
+        relatorio.append({"Técnico": tecnico_do_arquivo(arq), "Registros": qtd,
+                          "Fotos": sum(len(r["fotos"]) for r in fotos), "Leitura e preparo (s)": round(segundos, 2)})
+
+    t_gravacao = time.perf_counter()
+    gravar_pacote_zip(book, fotos_todas, destino)
+    t_fim = time.perf_counter()
+    tempos = {"Preparo em paralelo (s)": round(t_preparo, 2), "Planilha e fotos (s)": round(t_fim - t_gravacao, 2),
+              "Total (s)": round(t_fim - inicio, 2)}
+    return relatorio, tempos
+
+# CACHE DA EXPORTAÇÃO
+# Pacotes ZIP memorizados pela impressão digital do conteúdo (registros, bytes
+# do modelo e mtime das fotos). Compartilhado entre sessões, com descarte LRU.
+# No modo streaming o pacote fica num arquivo temporário em disco e cada
+# consumidor abre seu próprio handle: a montagem e o email não carregam o ZIP
+# inteiro. O download é a exceção: o Streamlit serve arquivos a partir do seu
+# armazenamento em memória, então cada clique copia o pacote para lá.
+CACHE_EXPORTACAO_MAX_ITENS = 8
+CACHE_EXPORTACAO_MAX_BYTES = 256 * 1024 * 1024
+LIMITE_SPOOL_BYTES = 8 * 1024 * 1024
+
+_cache_exportacao = OrderedDict()
+_cache_exportacao_lock = threading.Lock()
+_pasta_temp_exportacao = None
+
+class PacoteEmDisco:
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.tamanho = os.path.getsize(caminho)
+
+    def __len__(self):
+        return self.tamanho
+
+    def descartar(self):
+        try: os.remove(self.caminho)
+        except OSError: pass
+
+def _get_pasta_temp_exportacao():
+    global _pasta_temp_exportacao
+    if _pasta_temp_exportacao is None:
+        _pasta_temp_exportacao = tempfile.mkdtemp(prefix="poup_exportacao_")
+        atexit.register(shutil.rmtree, _pasta_temp_exportacao, True)
+    return _pasta_temp_exportacao
+
+def impressao_digital_exportacao(dados_lista, modelo_bytes):
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(modelo_bytes).digest())
+    h.update(json.dumps(dados_lista, sort_keys=True, default=str).encode("utf-8"))
+    for registro in dados_lista:
+        for foto in registro.get("fotos", []):
+            caminho = foto["caminho_fisico"]
+            try:
+                info = os.stat(caminho)
+                h.update(f"{caminho}|{info.st_mtime_ns}|{info.st_size}".encode("utf-8"))
+            except OSError:
+                h.update(f"{caminho}|ausente".encode("utf-8"))
+    return h.hexdigest()
+
+def _descartar_excedente_cache():
+    total = sum(len(v) for v in _cache_exportacao.values())
+    while len(_cache_exportacao) > 1 and (len(_cache_exportacao) > CACHE_EXPORTACAO_MAX_ITENS or total > CACHE_EXPORTACAO_MAX_BYTES):
+        _, antigo = _cache_exportacao.popitem(last=False)
+        total -= len(antigo)
+        if isinstance(antigo, PacoteEmDisco): antigo.descartar()
+
+def _montar_pacote(dados_lista, resumo_consumo=False, modelo_bytes=None):
+    if not EXPORTACAO_STREAMING:
+        zip_buffer = gerar_zip_exportacao(dados_lista, resumo_consumo=resumo_consumo, modelo_bytes=modelo_bytes)
+        return zip_buffer.getvalue() if zip_buffer else None
+    
+    fd, caminho = tempfile.mkstemp(suffix=".zip", dir=_get_pasta_temp_exportacao())
+    with os.fdopen(fd, "wb") as destino:
+        ok = gerar_zip_exportacao(dados_lista, destino=destino, resumo_consumo=resumo_consumo, modelo_bytes=modelo_bytes) is not None
+    if not ok:
+        os.remove(caminho)
+        return None
+    return PacoteEmDisco(caminho)
+
+def obter_zip_exportacao(dados_lista, resumo_consumo=False, modelo_bytes=None):
+    """
+    Versão memorizada de gerar_zip_exportacao: só monta o pacote quando o
+    conteúdo mudou. Retorna os bytes do ZIP (ou um PacoteEmDisco no modo streaming).
+    Sem 'modelo_bytes', usa o modelo da sessão.
+    """
+    if modelo_bytes is None:
+        if 'planilha_modelo' not in st.session_state: return None
+        modelo_bytes = st.session_state['planilha_modelo'].getvalue()
+    chave = impressao_digital_exportacao(dados_lista, modelo_bytes)
+    if resumo_consumo: chave += "|resumo"
+    
+    with _cache_exportacao_lock:
+        if chave in _cache_exportacao:
+            _cache_exportacao.move_to_end(chave)
+            return _cache_exportacao[chave]
+    
+    pacote = _montar_pacote(dados_lista, resumo_consumo, modelo_bytes)
+    if pacote is None: return None
+    
+    with _cache_exportacao_lock:
+        anterior = _cache_exportacao.pop(chave, None)
+        if isinstance(anterior, PacoteEmDisco): anterior.descartar()
+        _cache_exportacao[chave] = pacote
+        _descartar_excedente_cache()
+    return pacote
+
+@contextmanager
+def abrir_zip_exportacao(dados_lista, resumo_consumo=False, modelo_bytes=None):
+    """Entrega o pacote como arquivo aberto (fechado ao sair do bloco)."""
+    pacote = obter_zip_exportacao(dados_lista, resumo_consumo, modelo_bytes)
+    avulso = None
+    if isinstance(pacote, PacoteEmDisco):
+        try:
+            arquivo = open(pacote.caminho, "rb")
+        except FileNotFoundError:
+            # Descartado por outra sessão entre a consulta e a abertura
+            avulso = _montar_pacote(dados_lista, resumo_consumo, modelo_bytes)
+            arquivo = open(avulso.caminho, "rb") if avulso else None
+    else:
+        arquivo = io.BytesIO(pacote) if pacote is not None else None
+    try:
+        yield arquivo
+    finally:
+        if arquivo is not None: arquivo.close()
+        if avulso is not None: avulso.descartar()
+
+def download_zip_exportacao(dados_lista, resumo_consumo=False):
+    """
+    Função sem argumentos para st.download_button(data=...): o pacote só é montado
+    (e copiado para a memória do Streamlit) quando o botão é clicado. Roda fora
+    da sessão, então modelo, base e marca d'água são resolvidos aqui; espera as
+    fotos ainda em gravação antes de montar. A entrega só é registrada depois que
+    o pacote foi montado.
+    """
+    modelo = st.session_state.get('planilha_modelo')
+    modelo_bytes = modelo.getvalue() if modelo else None
+    path = get_user_data_path()
+    path_entregas = get_user_entregas_path()
+
+    def gerar():
+        if modelo_bytes is None: raise ValueError("Nenhum modelo de planilha carregado.")
+        aguardar_fotos_pendentes(path)
+        with abrir_zip_exportacao(registros_do_pacote(dados_lista, path), resumo_consumo, modelo_bytes) as arquivo:
+            if arquivo is None: raise ValueError("Não foi possível montar o pacote.")
+            conteudo = arquivo.read()
+        gravar_entrega(dados_entrega(dados_lista, "download", modelo_bytes), path_entregas)
+        return conteudo
+    return gerar
+
+# MARCA D'ÁGUA DAS ENTREGAS (exportação só do que é novo)
+# Cada pacote entregue (download ou email) fica registrado com a data, o canal,
+# a impressão digital do conteúdo e os IDs dos registros; "novos" são os
+# registros cujo ID ainda não saiu em nenhuma entrega. Um email só conta como
+# entregue quando a caixa de saída conclui o envio.
+def carregar_entregas(path_especifico=None):
+    path = path_especifico if path_especifico else get_user_entregas_path()
+    if path and os.path.exists(path):
+        with open(path, "r") as f: return json.load(f)
+    return {"entregas": [], "exportados": []}
+
+def dados_entrega(dados_lista, canal, modelo_bytes=None):
+    """O que a entrega registra. Sem 'modelo_bytes', usa o modelo da sessão."""
+    if modelo_bytes is None:
+        modelo = st.session_state.get('planilha_modelo')
+        modelo_bytes = modelo.getvalue() if modelo else b""
+    return {
+        "canal": canal, "ids": [r['id'] for r in dados_lista],
+        "impressao": impressao_digital_exportacao(dados_lista, modelo_bytes),
+    }
+
+def gravar_entrega(entrega, path):
+    if not path or not entrega["ids"]: return
+    with bloqueio_arquivo(path):
+        marca = carregar_entregas(path)
+        exportados = set(marca["exportados"])
+        novos = [i for i in entrega["ids"] if i not in exportados]
+        marca["exportados"].extend(novos)
+        marca["entregas"].append({
+            "data": get_data_hora_br().strftime("%d/%m/%Y %H:%M:%S"), "canal": entrega["canal"],
+            "registros": len(entrega["ids"]), "novos": len(novos), "impressao": entrega["impressao"],
+        })
+        gravar_json_atomico(path, marca)
+
+@outbox.ao_enviar
+def _registrar_entrega_email(envio):
+    entrega = envio.get("entrega")
+    if entrega: gravar_entrega(entrega, entrega["path"])
+
+def registros_nao_entregues(registros, path_especifico=None):
+    exportados = set(carregar_entregas(path_especifico)["exportados"])
+    return [r for r in registros if r['id'] not in exportados]
 
 # EMAIL (Atualizado para enviar ZIP se tiver fotos ou apenas Excel)
-def enviar_email(arquivo_buffer, destinatario, is_zip=False):
+def enviar_email(arquivo_buffer, destinatario, is_zip=False, dados_lista=None):
+    """
+    Coloca o envio na caixa de saída (outbox) e retorna o ID para acompanhar o
+    status; a entrega fica com o trabalhador em segundo plano. Com 'dados_lista',
+    os registros entram na marca d'água quando o envio for concluído.
+    """
+    entrega = None
+    if dados_lista:
+        entrega = {"path": get_user_entregas_path(), **dados_entrega(dados_lista, "email")}
     try:
-        msg = MIMEMultipart()
-        msg['From'] = "levantamento.poupenergia@gmail.com"
-        msg['To'] = destinatario
-        msg['Subject'] = f"Levantamento {st.session_state['usuario_ativo']} - {get_data_hora_br().strftime('%d/%m/%Y')}"
-        msg.attach(MIMEText("Segue em anexo o levantamento realizado.", 'plain'))
-        
-        part = MIMEBase('application', 'zip' if is_zip else 'octet-stream')
-        part.set_payload(arquivo_buffer.getvalue())
-        encoders.encode_base64(part)
-        
-        filename = "levantamento_completo.zip" if is_zip else "levantamento.xlsx"
-        part.add_header('Content-Disposition', f'attachment; filename={filename}')
-        
-        msg.attach(part)
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        # Nota: Idealmente usar variáveis de ambiente para senhas
-        server.login("levantamento.poupenergia@gmail.com", "kiqplowxqprcugjc")
-        server.send_message(msg)
-        server.quit()
-        return True
-    except Exception as e:
+        return outbox.enfileirar_email(
+            destinatario,
+            f"Levantamento {st.session_state['usuario_ativo']} - {get_data_hora_br().strftime('%d/%m/%Y')}",
+            "Segue em anexo o levantamento realizado.",
+            arquivo_buffer,
+            "levantamento_completo.zip" if is_zip else "levantamento.xlsx",
+            "application/zip" if is_zip else "application/octet-stream",
+            entrega=entrega,
+        )
+    except OSError as e:
         print(e)
-        return False
+        return None
@@ -3,7 +3,10 @@ import os
 import pandas as pd
 import utils
 import auth
-from collections import defaultdict
+import outbox
+import analise
+import perf
+from datetime import datetime
 
 
 # --- AUXILIARES VISUAIS & UI ---
@@ -35,8 +38,8 @@ def confirmar_salvamento_incompleto(novo_registro):
     col_sim, col_nao = st.columns(2)
     
     if col_sim.button("Sim, Salvar", use_container_width=True, type="primary"):
-        st.session_state['db_formularios'].append(novo_registro)
-        utils.salvar_dados_locais(st.session_state['db_formularios'])
+        st.session_state['indice_uc'].adicionar(novo_registro)
+        utils.adicionar_registros_locais([novo_registro])
         st.session_state['form_id'] += 1
         st.session_state['sucesso_salvamento'] = True 
         
@@ -48,16 +51,16 @@ def confirmar_salvamento_incompleto(novo_registro):
         st.rerun()
 
 @st.dialog("Confirmar Exclusão")
-def confirmar_exclusao_dialog(indices_alvo=None, tipo="item"):
+def confirmar_exclusao_dialog(ids_alvo=None, tipo="item"):
     """
-    indices_alvo: Lista de índices (inteiros) para remover do db_formularios.
-    tipo: 'item' (remove indices especificos) ou 'tudo' (limpa o banco).
+    ids_alvo: Lista de IDs de registros para remover do indice_uc.
+    tipo: 'item' (remove ids especificos) ou 'tudo' (limpa o banco).
     """
     st.markdown("### Ação Irreversível")
     st.warning("Você está prestes a remover registros permanentemente.")
     
-    if indices_alvo and len(indices_alvo) > 1:
-        st.info(f"Quantidade de itens selecionados para exclusão: {len(indices_alvo)}")
+    if ids_alvo and len(ids_alvo) > 1:
+        st.info(f"Quantidade de itens selecionados para exclusão: {len(ids_alvo)}")
     
     senha = st.text_input("Digite sua senha para confirmar", type="password")
     
@@ -70,14 +73,11 @@ def confirmar_exclusao_dialog(indices_alvo=None, tipo="item"):
         
         if valido:
             if tipo == "tudo":
-                st.session_state['db_formularios'] = []
-            elif indices_alvo:
-                # Remove itens de trás para frente
-                for i in sorted(indices_alvo, reverse=True):
-                    if 0 <= i < len(st.session_state['db_formularios']):
-                        st.session_state['db_formularios'].pop(i)
-            
-            utils.salvar_dados_locais(st.session_state['db_formularios'])
+                st.session_state['indice_uc'] = utils.IndiceUC()
+                utils.salvar_dados_locais([])
+            elif ids_alvo:
+                st.session_state['indice_uc'].remover(ids_alvo)
+                utils.remover_registros_locais(ids_alvo)
             st.rerun()
         else: st.error("Senha incorreta.")
     
@@ -109,8 +109,8 @@ def excluir_arquivo_permanente_dialog(caminho_arquivo):
         valido, _ = auth.verificar_senha(senha, admin_hash)
         if valido:
             try:
-                if os.path.exists(caminho_arquivo):
-                    os.remove(caminho_arquivo)
+                if caminho_arquivo in utils.listar_arquivos_dados():
+                    utils.excluir_arquivo_dados(caminho_arquivo)
                     st.success("Arquivo excluído.")
                     import time; time.sleep(1)
                     st.rerun()
@@ -135,6 +135,7 @@ def alterar_senha_dialog():
 
 # --- PÁGINAS DO SISTEMA ---
 
+@perf.medir("render_configurar_modelo")
 def render_configurar_modelo():
     main_header("tune", "Gerenciamento de Modelo")
     
@@ -163,11 +164,33 @@ def render_configurar_modelo():
         
         if arq:
             path = utils.get_user_template_path()
-            with open(path, "wb") as f: f.write(arq.getbuffer())
+            with utils.escrita_atomica(path, "wb") as f: f.write(arq.getbuffer())
             st.success("Modelo personalizado aplicado com sucesso!")
             utils.carregar_modelo_atual()
             st.rerun()
 
+    # Seção: Importação
+    with st.container(border=True):
+        section_title("upload", "Importar Levantamentos Preenchidos")
+        st.markdown("Traga planilhas já preenchidas no formato do modelo: cada linha de cada aba vira um registro.")
+        
+        preenchida = st.file_uploader("Planilha preenchida", type=["xlsx"], key="importar_planilha", label_visibility="collapsed")
+        if preenchida and st.button("Importar Registros", use_container_width=True, icon=":material/upload:"):
+            with st.spinner("Importando..."):
+                registros, por_aba, ignoradas = utils.importar_planilha_preenchida(preenchida)
+                # Uma única gravação para o lote inteiro
+                utils.adicionar_registros_locais(registros)
+                for reg in registros:
+                    st.session_state['indice_uc'].adicionar(reg)
+            if registros:
+                st.success(f"{len(registros)} registro(s) importado(s).")
+                st.dataframe(pd.DataFrame([{"Aba": aba, "Registros": qtd} for aba, qtd in por_aba.items()]), use_container_width=True, hide_index=True)
+            else:
+                st.warning("Nenhuma linha preenchida encontrada nas abas do modelo.")
+            if ignoradas:
+                st.info(f"Aba(s) fora do modelo ignorada(s): {', '.join(ignoradas)}.")
+
+@perf.medir("render_preenchimento")
 def render_preenchimento():
     # CSS para limpar inputs desabilitados (UI fix)
     st.markdown("""
@@ -309,6 +332,7 @@ def render_preenchimento():
                 if img_buffer:
                     st.session_state['fotos_temp'].append({
                         "arquivo": img_buffer,
+                        "miniatura": utils.gerar_miniatura_bytes(img_buffer),
                         "nome": nome_foto_atual if nome_foto_atual else f"Foto {len(st.session_state['fotos_temp'])+1}",
                         "origem": origem
                     })
@@ -324,7 +348,7 @@ def render_preenchimento():
                 for idx, item in enumerate(st.session_state['fotos_temp']):
                     with st.container(border=True):
                         c1, c2, c3 = st.columns([0.1, 0.7, 0.2])
-                        c1.image(item['arquivo'], width=60)
+                        c1.image(item.get('miniatura') or item['arquivo'], width=60)
                         c2.markdown(f"**{item['nome']}**")
                         if c3.button("Remover", key=f"rm_foto_{idx}", icon=":material/delete:", use_container_width=True):
                             st.session_state['fotos_temp'].pop(idx)
@@ -358,9 +382,11 @@ def processar_salvamento(loc_data, tipo, respostas, lista_fotos_temp, action_typ
     dados_completos = loc_data.copy()
     dados_completos.update(respostas)
 
-    meta_fotos = utils.salvar_fotos_local(lista_fotos_temp, uc)
+    # Fotos entram como 'pendente'; a gravação em disco segue em segundo plano
+    meta_fotos, trabalhos_fotos = utils.preparar_fotos(lista_fotos_temp)
     
     novo_registro = {
+        "id": utils.novo_id_registro(),
         "cod_instalacao": uc, 
         "tipo_equipamento": tipo, 
         "data_hora": utils.get_data_hora_br().strftime("%d/%m/%Y %H:%M:%S"), 
@@ -368,8 +394,9 @@ def processar_salvamento(loc_data, tipo, respostas, lista_fotos_temp, action_typ
         "fotos": meta_fotos
     }
     
-    st.session_state['db_formularios'].append(novo_registro)
-    utils.salvar_dados_locais(st.session_state['db_formularios'])
+    st.session_state['indice_uc'].adicionar(novo_registro)
+    utils.adicionar_registros_locais([novo_registro])
+    utils.agendar_gravacao_fotos(novo_registro, trabalhos_fotos)
     st.session_state['form_id'] += 1
     st.session_state['sucesso_salvamento'] = True 
     
@@ -391,116 +418,173 @@ def processar_salvamento(loc_data, tipo, respostas, lista_fotos_temp, action_typ
 
     st.rerun()
 
+def aguardar_fotos_para_exportacao():
+    """Fotos ainda em gravação entram no pacote; o que não terminar a tempo é avisado."""
+    with st.spinner("Concluindo gravação das fotos..."):
+        restantes = utils.aguardar_fotos_pendentes()
+    if restantes:
+        st.warning(f"{restantes} registro(s) ainda com fotos em gravação ficarão sem essas fotos no pacote.")
+
+GRUPOS_POR_PAGINA = 20
+ITENS_POR_PAGINA = 25
+
+def paginar(total, por_pagina, key, rotulo):
+    """Seletor de página; retorna a fatia (início, fim) a exibir."""
+    if total <= por_pagina:
+        return 0, total
+    paginas = (total - 1) // por_pagina + 1
+    c_pag, c_info = st.columns([0.3, 0.7])
+    pagina = c_pag.number_input("Página", min_value=1, max_value=paginas, value=1, step=1, key=key)
+    inicio = (pagina - 1) * por_pagina
+    fim = min(inicio + por_pagina, total)
+    c_info.caption(f"Exibindo {inicio + 1}–{fim} de {total} {rotulo} (página {pagina} de {paginas})")
+    return inicio, fim
+
+def render_grupo_uc(grupo, data_resumo):
+    uc = grupo['uc']
+    lista_itens = st.session_state['indice_uc'].registros_da_uc(uc)
+
+    # Header Interno
+    c_h1, c_h2, c_h3, c_h4 = st.columns([3, 2, 2, 3])
+    c_h1.caption("Unidade Consumidora")
+    c_h1.markdown(f"**{uc}**")
+    
+    c_h2.caption("Data Base")
+    c_h2.markdown(f"**{data_resumo}**")
+    
+    c_h3.caption("Fotos Totais")
+    c_h3.markdown(f"**{grupo['qtd_fotos']}**")
+    
+    c_h4.caption("Ações do Grupo")
+    if c_h4.button("Excluir Levantamento Completo", key=f"del_grp_{uc}", use_container_width=True, icon=":material/folder_delete:"):
+        # Ação vale para o grupo inteiro, não só para a página exibida
+        confirmar_exclusao_dialog(ids_alvo=[i['id'] for i in lista_itens], tipo="item")
+
+    st.divider()
+    
+    # Tabela de Itens
+    ini_i, fim_i = paginar(len(lista_itens), ITENS_POR_PAGINA, f"pag_itens_{uc}", "item(ns)")
+    for item in lista_itens[ini_i:fim_i]:
+        dados = item.get('dados', {})
+        tipo = item.get('tipo_equipamento', 'Equipamento')
+        data_hora = item.get('data_hora', '-')
+        fotos = item.get('fotos', [])
+        pav = dados.get('Pavimento', '-')
+        amb = dados.get('Ambiente', '-')
+
+        with st.container(border=True):
+            row1, row2, row3 = st.columns([0.4, 0.4, 0.2])
+            
+            with row1:
+                st.markdown(f"**{tipo}**")
+                st.caption(f"Local: {pav} > {amb}")
+            
+            with row2:
+                st.caption(f"Registro: {data_hora}")
+                if fotos:
+                    st.markdown(f"📎 {len(fotos)} anexo(s)")
+                    pendentes, falhas = utils.estado_fotos(item)
+                    if pendentes: st.caption(f"⏳ {pendentes} foto(s) sendo gravada(s)")
+                    if falhas: st.caption(f"⚠️ {falhas} foto(s) não gravada(s)")
+            
+            with row3:
+                # Alinhamento vertical para botão
+                st.markdown("<div style='height: 10px'></div>", unsafe_allow_html=True)
+                if st.button("Excluir", key=f"del_item_{item['id']}", icon=":material/delete:", use_container_width=True):
+                    confirmar_exclusao_dialog(ids_alvo=[item['id']], tipo="item")
+            
+            # Popover de fotos discreto: imagens só são montadas quando aberto
+            if fotos:
+                pop = st.popover("Visualizar Anexos", key=f"pop_{item['id']}", on_change="rerun")
+                if pop.open:
+                    with pop:
+                        render_anexos(item, fotos)
+
+def render_anexos(item, fotos):
+    cols_foto = st.columns(3)
+    for idx_f, f in enumerate(fotos):
+        with cols_foto[idx_f % 3]:
+            if not os.path.exists(f['caminho_fisico']):
+                st.caption(f"{f['nome_exportacao']} (indisponível)")
+                continue
+            st.image(utils.obter_miniatura(f) or f['caminho_fisico'], caption=f['nome_exportacao'], use_container_width=True)
+            # Original só sob demanda
+            if st.toggle("Original", key=f"orig_{item['id']}_{idx_f}"):
+                st.image(f['caminho_fisico'], use_container_width=True)
+
+@perf.medir("render_exportar_listar")
 def render_exportar_listar():
     main_header("table_view", "Gerenciamento de Levantamentos")
     
-    registros = st.session_state['db_formularios']
+    indice = st.session_state['indice_uc']
     
-    if not registros:
+    if not indice:
         st.info("Nenhum registro encontrado no banco de dados local.")
         return
 
     # Painel de Controle Geral
     with st.container(border=True):
         c_tot, c_act = st.columns([0.7, 0.3])
-        c_tot.metric("Total de Equipamentos Coletados", len(registros))
+        c_tot.metric("Total de Equipamentos Coletados", len(indice))
         if c_act.button("Excluir Tudo", type="primary", use_container_width=True, icon=":material/delete_forever:"):
-            confirmar_exclusao_dialog(indices_alvo=None, tipo="tudo")
+            confirmar_exclusao_dialog(ids_alvo=None, tipo="tudo")
 
     st.markdown("### Levantamentos por Unidade")
 
-    # Agrupamento
-    grupos_uc = defaultdict(list)
-    for idx, item in enumerate(registros):
-        uc_nome = item.get('cod_instalacao') or item.get('dados', {}).get('Nome da Unidade Consumidora', 'UC Indefinida')
-        grupos_uc[uc_nome].append((idx, item))
+    # Agrupamento mantido incrementalmente pelo índice da sessão
+    grupos_uc = indice.resumo()
 
-    # Listagem Hierárquica
-    for uc, lista_itens in grupos_uc.items():
-        qtd_equipamentos = len(lista_itens)
-        qtd_fotos_total = sum(len(i[1].get('fotos', [])) for i in lista_itens)
-        
-        datas = [i[1].get('data_hora', '-') for i in lista_itens]
-        data_resumo = datas[0].split()[0] if datas else "-"
+    # Listagem Hierárquica (paginada; corpo do grupo só é montado quando aberto)
+    ini_g, fim_g = paginar(len(grupos_uc), GRUPOS_POR_PAGINA, "pag_grupos", "unidade(s)")
+    for grupo in grupos_uc[ini_g:fim_g]:
+        uc = grupo['uc']
+        qtd_equipamentos = grupo['qtd_itens']
+        qtd_fotos_total = grupo['qtd_fotos']
+        data_resumo = (grupo['data_primeira'] or "-").split()[0]
 
         # Cabeçalho do Expander (Texto Limpo)
         expander_label = f"{uc}  |  {data_resumo}  |  {qtd_equipamentos} iten(s)"
 
-        with st.expander(expander_label, expanded=False):
-            # Header Interno
-            c_h1, c_h2, c_h3, c_h4 = st.columns([3, 2, 2, 3])
-            c_h1.caption("Unidade Consumidora")
-            c_h1.markdown(f"**{uc}**")
-            
-            c_h2.caption("Data Base")
-            c_h2.markdown(f"**{data_resumo}**")
-            
-            c_h3.caption("Fotos Totais")
-            c_h3.markdown(f"**{qtd_fotos_total}**")
-            
-            c_h4.caption("Ações do Grupo")
-            indices_grupo = [i[0] for i in lista_itens]
-            if c_h4.button("Excluir Levantamento Completo", key=f"del_grp_{uc}", use_container_width=True, icon=":material/folder_delete:"):
-                confirmar_exclusao_dialog(indices_alvo=indices_grupo, tipo="item")
-
-            st.divider()
-            
-            # Tabela de Itens
-            for real_idx, item in lista_itens:
-                dados = item.get('dados', {})
-                tipo = item.get('tipo_equipamento', 'Equipamento')
-                data_hora = item.get('data_hora', '-')
-                fotos = item.get('fotos', [])
-                pav = dados.get('Pavimento', '-')
-                amb = dados.get('Ambiente', '-')
-
-                with st.container(border=True):
-                    row1, row2, row3 = st.columns([0.4, 0.4, 0.2])
-                    
-                    with row1:
-                        st.markdown(f"**{tipo}**")
-                        st.caption(f"Local: {pav} > {amb}")
-                    
-                    with row2:
-                        st.caption(f"Registro: {data_hora}")
-                        if fotos:
-                            st.markdown(f"📎 {len(fotos)} anexo(s)")
-                    
-                    with row3:
-                        # Alinhamento vertical para botão
-                        st.markdown("<div style='height: 10px'></div>", unsafe_allow_html=True)
-                        if st.button("Excluir", key=f"del_item_{real_idx}", icon=":material/delete:", use_container_width=True):
-                            confirmar_exclusao_dialog(indices_alvo=[real_idx], tipo="item")
-                    
-                    # Expander de fotos discreto
-                    if fotos:
-                        with st.popover("Visualizar Anexos"):
-                            cols_foto = st.columns(3)
-                            for idx_f, f in enumerate(fotos):
-                                with cols_foto[idx_f % 3]:
-                                    st.image(f['caminho_fisico'], caption=f['nome_exportacao'], use_container_width=True)
+        exp = st.expander(expander_label, expanded=False, key=f"exp_uc_{uc}", on_change="rerun")
+        if not exp.open:
+            continue
+        with exp:
+            render_grupo_uc(grupo, data_resumo)
 
     st.markdown("---")
     
     # Rodapé: Exportação
     main_header("download", "Exportação de Dados")
     
-    zip_data = utils.gerar_zip_exportacao(st.session_state['db_formularios'])
+    # Completo ou só o que ainda não foi entregue (marca d'água por técnico)
+    entregas = utils.carregar_entregas()
+    # Contagens e seleção pelo índice da sessão; a base só é consultada ao montar o pacote
+    todos = indice.listar()
+    modo = st.radio("Conteúdo do pacote", ["Completo", "Somente novos desde a última entrega"], horizontal=True, key="modo_exportacao")
+    if entregas["entregas"]:
+        ultima = entregas["entregas"][-1]
+        st.caption(f"Última entrega: {ultima['data']} por {ultima['canal']} ({ultima['registros']} registro(s)).")
+    dados_exportacao = todos if modo == "Completo" else utils.registros_nao_entregues(todos)
+    if not dados_exportacao:
+        st.info("Nenhum registro novo desde a última entrega.")
+        render_envio_email()
+        return
+    if modo != "Completo":
+        st.caption(f"{len(dados_exportacao)} registro(s) novo(s) de {len(todos)}.")
+    resumo_consumo = st.checkbox("Incluir aba 'Resumo de Consumo' (kWh estimado por UC e tipo)", key="exportar_resumo_consumo")
     
+    # Pacote montado só sob demanda: no clique do download (em outra thread) ou no envio
     col_dl, col_email = st.columns(2)
     with col_dl:
-        if zip_data:
-            st.download_button(
-                "Baixar Pacote Completo (.zip)", 
-                data=zip_data, 
-                file_name="levantamento_poup.zip", 
-                mime="application/zip",
-                use_container_width=True, 
-                type="primary",
-                icon=":material/archive:"
-            )
-        else:
-            st.button("Baixar Pacote Completo", disabled=True, use_container_width=True)
+        st.download_button(
+            "Baixar Pacote (.zip)", 
+            data=utils.download_zip_exportacao(dados_exportacao, resumo_consumo), 
+            file_name="levantamento_poup.zip", 
+            mime="application/zip",
+            use_container_width=True, 
+            type="primary",
+            icon=":material/archive:",
+        )
             
     with col_email:
         with st.form("form_email_envio"):
@@ -508,16 +592,165 @@ def render_exportar_listar():
             email_dest = c_e1.text_input("Email", placeholder="usuario@empresa.com", label_visibility="collapsed")
             btn_env = c_e2.form_submit_button("Enviar", icon=":material/send:", use_container_width=True)
             
-            if btn_env:
-                if email_dest and zip_data and utils.enviar_email(zip_data, email_dest, is_zip=True):
-                    st.success("Relatório enviado!")
+            if btn_env and outbox.erro_configuracao():
+                st.error(outbox.erro_configuracao())
+            elif btn_env:
+                id_envio = None
+                if email_dest:
+                    aguardar_fotos_para_exportacao()
+                    with utils.abrir_zip_exportacao(utils.registros_do_pacote(dados_exportacao), resumo_consumo) as zip_data:
+                        id_envio = zip_data is not None and utils.enviar_email(zip_data, email_dest, is_zip=True, dados_lista=dados_exportacao)
+                if id_envio:
+                    # Entrega registrada pela caixa de saída só quando o envio é concluído
+                    st.session_state['envio_email_id'] = id_envio
+                    st.session_state.pop('envio_email_final', None)
                 else:
                     st.error("Erro ao enviar ou email inválido.")
 
+        render_envio_email()
+
+def render_envio_email():
+    """Status do último envio: acompanhado enquanto não termina, depois exibido uma vez."""
+    if st.session_state.get('envio_email_id'):
+        render_status_envio()
+    elif st.session_state.get('envio_email_final'):
+        mensagem_envio(st.session_state.pop('envio_email_final'))
+
+@st.fragment(run_every=2)
+def render_status_envio():
+    """Acompanha o envio na caixa de saída sem rerodar a página inteira."""
+    envio = outbox.estado_envio(st.session_state['envio_email_id'])
+    if envio is None or envio['status'] in (outbox.ENVIADO, outbox.FALHOU):
+        # Estado final: a página é rerodada sem o fragmento, que para de consultar
+        st.session_state['envio_email_final'] = envio
+        del st.session_state['envio_email_id']
+        st.rerun()
+    mensagem_envio(envio)
+
+def mensagem_envio(envio):
+    if envio['status'] == outbox.ENVIADO:
+        st.success("Relatório enviado!" if envio['partes'] == 1 else f"Relatório enviado em {envio['partes']} partes!")
+    elif envio['status'] == outbox.FALHOU:
+        st.error(f"Não foi possível enviar após {envio['tentativas']} tentativa(s): {envio['erro']}" if envio['tentativas'] else envio['erro'])
+    elif envio['tentativas'] and envio['status'] == outbox.PENDENTE:
+        st.warning(f"Falha na tentativa {envio['tentativas']}; nova tentativa em instantes. ({envio['erro']})")
+    elif envio['partes'] > 1:
+        st.info(f"Pacote grande: enviando em {envio['partes']} emails ({envio['partes_enviadas']} enviado(s))...", icon=":material/schedule_send:")
+    else:
+        st.info("Relatório na fila de envio...", icon=":material/schedule_send:")
+
+LIMITE_PREVIA_AUDITORIA = 200
+
+def render_consolidacao(arquivos):
+    """Pacote único (planilha + fotos) com as bases de vários técnicos."""
+    with st.container(border=True):
+        section_title("merge", "Consolidar Campanha")
+        st.caption("Junta as bases selecionadas no modelo padrão do sistema, com todas as fotos, em um único pacote.")
+        selecionados = st.multiselect("Bases a consolidar", arquivos, default=arquivos, format_func=utils.tecnico_do_arquivo)
+
+        if st.button("Consolidar Selecionados", disabled=not selecionados, use_container_width=True, icon=":material/merge:"):
+            if not os.path.exists(utils.PLANILHA_PADRAO_ADMIN):
+                st.error("Arquivo template 'Levantamento_Base.xlsx' não encontrado!")
+                return
+            with open(utils.PLANILHA_PADRAO_ADMIN, "rb") as f: modelo_bytes = f.read()
+
+            anterior = st.session_state.pop('consolidacao', None)
+            if anterior: anterior['pacote'].descartar()
+            caminho = os.path.join(utils._get_pasta_temp_exportacao(), f"consolidado_{utils.novo_id_registro()}.zip")
+            with st.spinner("Consolidando bases..."):
+                with open(caminho, "wb") as destino:
+                    relatorio, tempos = utils.consolidar_levantamentos(selecionados, modelo_bytes, destino)
+            st.session_state['consolidacao'] = {"pacote": utils.PacoteEmDisco(caminho), "relatorio": relatorio, "tempos": tempos}
+
+        consolidacao = st.session_state.get('consolidacao')
+        if consolidacao and os.path.exists(consolidacao['pacote'].caminho):
+            st.dataframe(pd.DataFrame(consolidacao['relatorio']), use_container_width=True, hide_index=True)
+            st.caption(" · ".join(f"{etapa}: {valor}" for etapa, valor in consolidacao['tempos'].items()))
+            with open(consolidacao['pacote'].caminho, "rb") as pacote:
+                st.download_button("Baixar Pacote Consolidado", data=pacote, file_name=f"campanha_{utils.get_data_hora_br().strftime('%Y%m%d')}.zip",
+                                   mime="application/zip", use_container_width=True, type="primary", icon=":material/archive:")
+
+@perf.medir("render_analise")
+def render_analise():
+    main_header("monitoring", "Análise de Consumo")
+    
+    indice = st.session_state['indice_uc']
+    if not indice:
+        st.info("Nenhum registro encontrado no banco de dados local.")
+        return
+
+    # Quadro refeito só quando os registros da sessão mudam (ou o índice é outro)
+    chave = (indice.token, indice.versao)
+    cache = st.session_state.get('analise_cache')
+    if not cache or cache[0] != chave:
+        with st.spinner("Calculando consumo estimado..."):
+            cache = (chave, *analise.montar_quadro(indice.listar()))
+        st.session_state['analise_cache'] = cache
+    _, quadro, problemas = cache
+
+    if quadro.empty:
+        st.info("Nenhum equipamento com dados de potência e regime de uso (Painéis Fotovoltaicos e Aquecimento de Água não entram na estimativa).")
+        return
+
+    with st.container(border=True):
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Consumo Estimado (kWh/mês)", f"{quadro['kWh/mês'].sum():,.0f}".replace(",", "."))
+        c2.metric("Consumo Estimado (kWh/ano)", f"{quadro['kWh/ano'].sum():,.0f}".replace(",", "."))
+        c3.metric("Itens sem Estimativa", int(quadro['kWh/mês'].isna().sum()))
+
+    nivel = st.selectbox("Agrupar por", list(analise.NIVEIS), key="analise_nivel")
+    resumo = analise.resumo_consumo(quadro, nivel)
+    
+    grafico = resumo.head(20).assign(Grupo=resumo.head(20)[analise.NIVEIS[nivel]].astype(str).agg(" > ".join, axis=1))
+    st.bar_chart(grafico, x="Grupo", y="kWh/mês", horizontal=True, sort="-kWh/mês")
+    st.dataframe(resumo, use_container_width=True, hide_index=True, column_config={
+        "kWh/mês": st.column_config.NumberColumn(format="%.1f"),
+        "kWh/ano": st.column_config.NumberColumn(format="%.1f"),
+    })
+
+    if not problemas.empty:
+        with st.expander(f"{len(problemas)} valor(es) preenchido(s) que não puderam ser lidos como número"):
+            st.caption("Esses campos ficam fora da conta; corrija-os no registro para entrarem na estimativa.")
+            st.dataframe(problemas, use_container_width=True, hide_index=True)
+
+def tabela_percentis(df, chaves):
+    """p50/p95/máximo (em ms) das amostras agrupadas pelas colunas 'chaves'."""
+    ms = df.assign(ms=df["segundos"] * 1000).groupby(chaves)["ms"]
+    tabela = pd.DataFrame({
+        "Amostras": ms.size(), "p50 (ms)": ms.quantile(0.5), "p95 (ms)": ms.quantile(0.95), "Máx (ms)": ms.max(),
+    }).round(1).reset_index()
+    return tabela.sort_values("p95 (ms)", ascending=False)
+
+def render_desempenho():
+    section_title("speed", "Tempos por Operação")
+    if not perf.ATIVO:
+        st.info("Medição desativada. Inicie o servidor com POUP_PERF=1 para coletar os tempos.")
+        return
+
+    amostras = perf.amostras()
+    if not amostras:
+        st.info("Nenhuma amostra coletada ainda.")
+        return
+
+    df = pd.DataFrame(amostras, columns=["momento", "usuario", "operacao", "segundos"])
+    inicio = datetime.fromtimestamp(df["momento"].min(), utils.get_data_hora_br().tzinfo)
+    st.caption(f"{len(df)} amostra(s) desde {inicio.strftime('%d/%m/%Y %H:%M')} (últimas {perf.LIMITE_AMOSTRAS} no máximo).")
+    st.dataframe(tabela_percentis(df, ["operacao"]).rename(columns={"operacao": "Operação"}),
+                 use_container_width=True, hide_index=True)
+
+    section_title("group", "Por Técnico")
+    por_tecnico = tabela_percentis(df, ["usuario", "operacao"]).sort_values("usuario", kind="stable")
+    st.dataframe(por_tecnico.rename(columns={"usuario": "Técnico", "operacao": "Operação"}), use_container_width=True, hide_index=True)
+
+    if st.button("Limpar Amostras", icon=":material/delete_sweep:"):
+        perf.limpar()
+        st.rerun()
+
+@perf.medir("render_admin_panel")
 def render_admin_panel():
     main_header("admin_panel_settings", "Painel Administrativo")
     
-    tab_users, tab_audit, tab_master = st.tabs(["Equipe Técnica", "Auditoria de Dados", "Modelo de Dados"])
+    tab_users, tab_audit, tab_master, tab_perf = st.tabs(["Equipe Técnica", "Auditoria de Dados", "Modelo de Dados", "Desempenho"])
     
     with tab_users:
         with st.container(border=True):
@@ -529,9 +762,9 @@ def render_admin_panel():
                 c3.markdown("<div style='height: 28px'></div>", unsafe_allow_html=True)
                 if c3.form_submit_button("Adicionar", use_container_width=True, type="primary"):
                     if new_u and new_p:
-                        d = auth.carregar_usuarios()
-                        d[new_u] = auth.hash_senha(new_p) 
-                        auth.salvar_usuarios(d)
+                        novo_hash = auth.hash_senha(new_p)
+                        with auth.editar_usuarios() as d:
+                            d[new_u] = novo_hash
                         st.success("Cadastrado com sucesso!")
                     else:
                         st.error("Dados incompletos.")
@@ -553,30 +786,44 @@ def render_admin_panel():
 
     with tab_audit:
         section_title("history", "Histórico de Arquivos Locais")
-        arquivos = sorted([f for f in os.listdir(".") if f.startswith("dados_") and f.endswith(".json")])
+        arquivos = utils.listar_arquivos_dados()
         
         if arquivos:
             sel = st.selectbox("Selecione o arquivo de backup:", arquivos)
-            dados_rec = utils.carregar_dados_locais(path_especifico=sel)
+            meta = utils.metadados_arquivo(sel)
             
-            # Métricas
-            cm1, cm2 = st.columns(2)
-            cm1.metric("Registros", len(dados_rec))
-            cm2.metric("Tamanho", f"{(os.path.getsize(sel)/1024):.2f} KB")
+            # Métricas (índice de metadados: a base só é relida se mudou)
+            cm1, cm2, cm3, cm4 = st.columns(4)
+            cm1.metric("Registros", meta['registros'])
+            cm2.metric("UCs", meta['ucs'])
+            # No SQLite: volume dos registros do técnico e data do registro mais recente
+            cm3.metric("Tamanho dos Dados" if utils.usar_sqlite() else "Tamanho", f"{(meta['tamanho']/1024):.2f} KB")
+            modificado = datetime.fromtimestamp(meta['modificado'], utils.get_data_hora_br().tzinfo) if meta['modificado'] else None
+            cm4.metric("Último Registro" if utils.usar_sqlite() else "Última Alteração", modificado.strftime('%d/%m/%Y %H:%M') if modificado else "-")
             
-            # Preview
-            st.caption("Visualização Rápida dos Dados")
-            df = pd.DataFrame([{"UC": d.get('cod_instalacao'), "Tipo": d.get('tipo_equipamento'), "Data": d.get('data_hora')} for d in dados_rec])
+            # Preview (só o começo da base)
+            st.caption(f"Visualização Rápida dos Dados (primeiros {min(LIMITE_PREVIA_AUDITORIA, meta['registros'])} de {meta['registros']})")
+            df = pd.DataFrame(utils.previa_registros(sel, limite=LIMITE_PREVIA_AUDITORIA))
             st.dataframe(df, use_container_width=True, hide_index=True)
             
-            # Ações
+            # Ações (planilha só é montada quando pedida)
             c_act1, c_act2 = st.columns(2)
-            rec_excel = utils.exportar_para_excel(dados_rec)
-            if rec_excel:
-                 c_act1.download_button("Baixar Planilha (Excel)", data=rec_excel, file_name=f"backup_{sel}.xlsx", use_container_width=True, icon=":material/download:")
+            planilha = st.session_state.get('auditoria_excel')
+            if planilha and planilha['arquivo'] == sel:
+                c_act1.download_button("Baixar Planilha (Excel)", data=planilha['dados'], file_name=f"backup_{sel}.xlsx", use_container_width=True, icon=":material/download:",
+                                       on_click=lambda: st.session_state.pop('auditoria_excel', None))
+            elif c_act1.button("Gerar Planilha (Excel)", use_container_width=True, icon=":material/table_view:"):
+                with st.spinner("Montando planilha..."):
+                    rec_excel = utils.exportar_para_excel(utils.registros_para_exportacao(path_especifico=sel))
+                if rec_excel:
+                    st.session_state['auditoria_excel'] = {"arquivo": sel, "dados": rec_excel}
+                    st.rerun()
 
             if c_act2.button("Apagar Arquivo do Servidor", use_container_width=True, icon=":material/delete_forever:"):
                 excluir_arquivo_permanente_dialog(sel)
+
+            st.markdown("<br>", unsafe_allow_html=True)
+            render_consolidacao(arquivos)
         else:
             st.info("Nenhum arquivo de backup encontrado.")
     
@@ -587,6 +834,8 @@ def render_admin_panel():
             
             mestre = st.file_uploader("Substituir 'Levantamento_Base.xlsx'", type=["xlsx"])
             if mestre:
-                with open(utils.PLANILHA_PADRAO_ADMIN, "wb") as f: f.write(mestre.getbuffer())
+                with utils.escrita_atomica(utils.PLANILHA_PADRAO_ADMIN, "wb") as f: f.write(mestre.getbuffer())
                 st.success("Modelo Padrão atualizado com sucesso!")
 
+    with tab_perf:
+        render_desempenho()